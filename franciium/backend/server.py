@@ -1,31 +1,77 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header, Request
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header, Query, Request, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse, StreamingResponse
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument, ReplaceOne, UpdateOne, monitoring
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError, model_validator
+from typing import List, Optional, Dict, Any, Literal
 import uuid
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
 import hashlib
 import secrets
-import razorpay
+import threading
+import hmac
+import httpx
 from passlib.context import CryptContext
 import jwt
 from uuid import uuid4
 from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import OrderedDict
+import asyncio
+import base64
+import bisect
+import codecs
+import csv
+import gzip
+import io
+import json
+import math
+import orjson
+import random
+import re
+import time
+import zlib
+
+# Optional codecs: "br" and "zstd" are only negotiated when their package is installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
+# MongoDB connection; the client is created in lifespan (see MONGO CLIENT)
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+client: Optional[AsyncIOMotorClient] = None
+db = None
+catalog_db = None  # same database with MONGO_CATALOG_READ_PREFERENCE, for reads that tolerate staleness
+
+# Connection pool and read routing
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', '100'))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', '0'))
+MONGO_MAX_IDLE_TIME_MS = int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', '0'))  # 0 keeps idle connections open
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', '0'))  # 0 waits for a free connection indefinitely
+MONGO_COMPRESSORS = os.environ.get('MONGO_COMPRESSORS', '')  # e.g. "zstd,snappy,zlib"
+MONGO_READ_PREFERENCE = os.environ.get('MONGO_READ_PREFERENCE', 'primary')
+MONGO_CATALOG_READ_PREFERENCE = os.environ.get('MONGO_CATALOG_READ_PREFERENCE', 'primary')  # e.g. "secondaryPreferred"
+MONGO_CATALOG_MAX_STALENESS_SECONDS = int(os.environ.get('MONGO_CATALOG_MAX_STALENESS_SECONDS', '-1'))  # -1 means no limit, else >= 90
+MONGO_WARMUP_CONNECTIONS = int(os.environ.get('MONGO_WARMUP_CONNECTIONS', str(MONGO_MIN_POOL_SIZE)))
 
 # Security
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -34,8 +80,80 @@ JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key-here')
 RAZORPAY_KEY_ID = os.environ.get('RAZORPAY_KEY_ID', 'rzp_test_dummy_key')
 RAZORPAY_KEY_SECRET = os.environ.get('RAZORPAY_KEY_SECRET', 'dummy_secret_key')
 
-# Initialize Razorpay client
-razorpay_client = razorpay.Client(auth=(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET))
+# Password hashing pool
+PASSWORD_HASH_EXECUTOR = os.environ.get('PASSWORD_HASH_EXECUTOR', 'thread')  # thread or process
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', '4'))
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', '64'))
+
+# Authenticated-user cache
+USER_CACHE_ENABLED = os.environ.get('USER_CACHE_ENABLED', 'true').lower() == 'true'
+USER_CACHE_TTL_SECONDS = float(os.environ.get('USER_CACHE_TTL_SECONDS', '60'))
+USER_CACHE_MAX_SIZE = int(os.environ.get('USER_CACHE_MAX_SIZE', '10000'))
+
+# Self-contained tokens carry role and token version so authorization can skip the users lookup
+JWT_SELF_CONTAINED_TOKENS = os.environ.get('JWT_SELF_CONTAINED_TOKENS', 'false').lower() == 'true'
+TOKEN_VERSION_CACHE_TTL_SECONDS = float(os.environ.get('TOKEN_VERSION_CACHE_TTL_SECONDS', '30'))
+
+# Cache backend: "memory" keeps caches per worker, "redis" shares values and invalidations across workers
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory')
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+CACHE_KEY_PREFIX = os.environ.get('CACHE_KEY_PREFIX', 'francium')
+
+# Product caches (by id, and by listing query)
+PRODUCT_CACHE_ENABLED = os.environ.get('PRODUCT_CACHE_ENABLED', 'true').lower() == 'true'
+PRODUCT_CACHE_TTL_SECONDS = float(os.environ.get('PRODUCT_CACHE_TTL_SECONDS', '300'))
+PRODUCT_CACHE_MAX_SIZE = int(os.environ.get('PRODUCT_CACHE_MAX_SIZE', '10000'))
+PRODUCT_QUERY_CACHE_TTL_SECONDS = float(os.environ.get('PRODUCT_QUERY_CACHE_TTL_SECONDS', '60'))
+PRODUCT_QUERY_CACHE_MAX_SIZE = int(os.environ.get('PRODUCT_QUERY_CACHE_MAX_SIZE', '1000'))
+
+# HTTP caching for catalog reads
+CATALOG_CACHE_MAX_AGE = int(os.environ.get('CATALOG_CACHE_MAX_AGE', '60'))
+CATALOG_STALE_WHILE_REVALIDATE = int(os.environ.get('CATALOG_STALE_WHILE_REVALIDATE', '300'))
+CATALOG_VERSION_CACHE_TTL_SECONDS = float(os.environ.get('CATALOG_VERSION_CACHE_TTL_SECONDS', '5'))
+
+# Category counts are kept in category_counts and periodically reconciled against products
+CATEGORY_CACHE_TTL_SECONDS = float(os.environ.get('CATEGORY_CACHE_TTL_SECONDS', '300'))
+CATEGORY_RECONCILE_INTERVAL_SECONDS = float(os.environ.get('CATEGORY_RECONCILE_INTERVAL_SECONDS', '900'))
+
+# Stock taken at order creation is held this long for payment, then released by the sweeper
+STOCK_RESERVATION_TTL_SECONDS = float(os.environ.get('STOCK_RESERVATION_TTL_SECONDS', '900'))
+RESERVATION_SWEEP_INTERVAL_SECONDS = float(os.environ.get('RESERVATION_SWEEP_INTERVAL_SECONDS', '60'))
+# Displayed stock is read live at request time (product counter plus any shards) and cached this briefly
+STOCK_CACHE_TTL_SECONDS = float(os.environ.get('STOCK_CACHE_TTL_SECONDS', '2'))
+MAX_STOCK_SHARDS = 64
+
+# Idempotency-Key handling: stored responses live for IDEMPOTENCY_TTL_SECONDS; a duplicate waits up to
+# IDEMPOTENCY_WAIT_SECONDS for the first request, whose claim lapses after IDEMPOTENCY_LOCK_SECONDS
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', '86400'))
+IDEMPOTENCY_WAIT_SECONDS = float(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', '10'))
+IDEMPOTENCY_LOCK_SECONDS = float(os.environ.get('IDEMPOTENCY_LOCK_SECONDS', '60'))
+
+# Product search: "index" uses the in-process inverted index, "regex" the old $regex scan
+SEARCH_MODE = os.environ.get('SEARCH_MODE', 'index')
+
+# Bulk product imports are validated and written IMPORT_CHUNK_SIZE rows at a time
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', '1000'))
+IMPORT_MAX_ERRORS = int(os.environ.get('IMPORT_MAX_ERRORS', '1000'))
+
+# Response compression; encodings are listed in server preference order
+COMPRESSION_ENABLED = os.environ.get('COMPRESSION_ENABLED', 'true').lower() == 'true'
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))
+COMPRESSION_ENCODINGS = [e.strip() for e in os.environ.get('COMPRESSION_ENCODINGS', 'zstd,br,gzip').split(',') if e.strip()]
+CATALOG_PAYLOAD_CACHE_MAX_SIZE = int(os.environ.get('CATALOG_PAYLOAD_CACHE_MAX_SIZE', '500'))
+
+# Sample catalog inserted on first start into an empty products collection; empty disables seeding
+SEED_PRODUCTS_FILE = os.environ.get('SEED_PRODUCTS_FILE', str(ROOT_DIR / 'fixtures' / 'sample_products.json'))
+
+# Admin exports stream from a Mongo cursor; each batch is fetched and written out before the next
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '500'))
+
+# Payment gateway: "razorpay" talks to the live API, "fake" is a local stand-in for tests
+PAYMENT_GATEWAY = os.environ.get('PAYMENT_GATEWAY', 'razorpay')
+RAZORPAY_API_URL = os.environ.get('RAZORPAY_API_URL', 'https://api.razorpay.com/v1')
+PAYMENT_GATEWAY_TIMEOUT_SECONDS = float(os.environ.get('PAYMENT_GATEWAY_TIMEOUT_SECONDS', '10'))
+PAYMENT_GATEWAY_MAX_RETRIES = int(os.environ.get('PAYMENT_GATEWAY_MAX_RETRIES', '2'))
+PAYMENT_GATEWAY_BREAKER_THRESHOLD = int(os.environ.get('PAYMENT_GATEWAY_BREAKER_THRESHOLD', '5'))
+PAYMENT_GATEWAY_BREAKER_RESET_SECONDS = float(os.environ.get('PAYMENT_GATEWAY_BREAKER_RESET_SECONDS', '30'))
 
 # Create the main app
 # app = FastAPI(title="Francium E-commerce API")
@@ -46,13 +164,19 @@ api_router = APIRouter(prefix="/api")
 class User(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid4()))
     email: str
-    password_hash: str
+    password_hash: Optional[str] = None  # projected out when loading the authenticated user
     full_name: str
     role: str = "customer"  # customer or admin
     phone: Optional[str] = None
     address: Optional[str] = None
+    token_version: int = 0
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
+class TokenClaims(BaseModel):
+    id: str = Field(alias="sub")
+    role: str = "customer"
+    token_version: int = Field(default=0, alias="ver")
+
 class UserCreate(BaseModel):
     email: str
     password: str
@@ -72,6 +196,8 @@ class Product(BaseModel):
     category: str
     image_url: str
     stock: int = 0
+    stock_shards: int = 0  # > 0 keeps stock in that many sub-counters (see INVENTORY)
+    sku: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
@@ -82,6 +208,14 @@ class ProductCreate(BaseModel):
     category: str
     image_url: str
     stock: int = 0
+    sku: Optional[str] = None
+
+# One row of a bulk import; matched on id if given, else on sku, else inserted as a new product
+class ProductImportRow(ProductCreate):
+    id: Optional[str] = None
+
+class StockShardsUpdate(BaseModel):
+    shards: int = Field(ge=0, le=MAX_STOCK_SHARDS)
 
 class CartItem(BaseModel):
     product_id: str
@@ -105,19 +239,328 @@ class Order(BaseModel):
     razorpay_order_id: Optional[str] = None
     razorpay_payment_id: Optional[str] = None
     shipping_address: str
+    stock_status: Optional[str] = None  # reserving, reserved, committed, released
+    reservation_expires_at: Optional[datetime] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
+# Sparse fieldsets (?fields=) for list endpoints; id is always included
+PRODUCT_FIELD_PRESETS = {"card": ["id", "name", "price", "image_url"]}
+ORDER_FIELD_PRESETS = {"summary": ["id", "total", "payment_status", "order_status", "created_at"]}
+
+def parse_fields(fields: Optional[str], model, presets: Dict[str, List[str]]) -> Optional[List[str]]:
+    if not fields:
+        return None
+    if fields in presets:
+        return presets[fields]
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = sorted(set(requested) - set(model.model_fields))
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return list(dict.fromkeys(["id", *requested]))
+
+def fields_projection(fields: Optional[List[str]], *required: str) -> Dict[str, int]:
+    if not fields:
+        return {"_id": 0}
+    return {"_id": 0, **{field: 1 for field in (*fields, *required)}}
+
+def select_fields(doc: Dict[str, Any], fields: Optional[List[str]]) -> Dict[str, Any]:
+    if not fields:
+        return doc
+    return {field: doc[field] for field in fields if field in doc}
+
+# List endpoints validate Mongo documents once through these and serialize straight to JSON bytes
+product_list_adapter = TypeAdapter(List[Product])
+order_list_adapter = TypeAdapter(List[Order])
+sparse_list_adapter = TypeAdapter(List[Dict[str, Any]])
+
 class RazorpayOrder(BaseModel):
     amount: int  # in paise
     currency: str = "INR"
 
 class AddToCart(BaseModel):
     product_id: str
-    quantity: int = 1
+    quantity: int = Field(default=1, ge=1)
+
+class SetCartQuantity(BaseModel):
+    quantity: int = Field(ge=0)  # 0 removes the line
+
+class CartOperation(BaseModel):
+    product_id: str
+    op: Literal["add", "set", "remove"] = "add"
+    quantity: int = Field(default=1, ge=0)  # 0 only means something for set, where it removes the line
+
+    @model_validator(mode="after")
+    def check_add_quantity(self):
+        if self.op == "add" and self.quantity < 1:
+            raise ValueError("quantity must be at least 1 for add")
+        return self
+
+class CartBatch(BaseModel):
+    operations: List[CartOperation] = Field(min_length=1, max_length=100)
 
 class CreateOrder(BaseModel):
     shipping_address: str
 
+# === CACHING ===
+# Bounded LRU with a per-entry TTL; None is never stored so it doubles as the miss marker
+class TTLCache:
+    def __init__(self, ttl: float, max_size: int, enabled: bool = True):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if not self.enabled or value is None:
+            return
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+def _cache_json_default(obj):
+    if isinstance(obj, datetime):
+        return {"$date": obj.isoformat()}
+    raise TypeError(f"Cannot cache {type(obj).__name__}")
+
+def _cache_json_hook(obj):
+    if len(obj) == 1 and "$date" in obj:
+        return datetime.fromisoformat(obj["$date"])
+    return obj
+
+def _cache_key(key) -> Any:
+    # Keys arrive back from JSON as lists
+    return tuple(key) if isinstance(key, list) else key
+
+# Single-process backend: nothing is shared and invalidations have nobody else to reach
+class MemoryCacheBackend:
+    name = "memory"
+    shared = False
+
+    async def start(self, on_invalidate):
+        pass
+
+    async def get(self, namespace: str, key):
+        return None
+
+    async def set(self, namespace: str, key, value, ttl: float):
+        pass
+
+    async def delete(self, namespace: str, key):
+        pass
+
+    async def clear(self, namespace: str):
+        pass
+
+    async def publish(self, namespace: str, key):
+        pass
+
+    async def close(self):
+        pass
+
+# Stores JSON values under <prefix>:<namespace>:<key> and fans invalidations out over pub/sub.
+# Takes any redis.asyncio-compatible client, so tests can pass a fakeredis instance.
+class RedisCacheBackend:
+    name = "redis"
+    shared = True
+
+    def __init__(self, redis_client, prefix: str):
+        self.redis = redis_client
+        self.prefix = prefix
+        self.channel = f"{prefix}:cache-invalidation"
+        self.origin = uuid4().hex
+        self._listener: Optional[asyncio.Task] = None
+
+    def _key(self, namespace: str, key) -> str:
+        return f"{self.prefix}:{namespace}:{json.dumps(key, default=str)}"
+
+    async def start(self, on_invalidate):
+        self._listener = asyncio.create_task(self._listen(on_invalidate))
+
+    async def _listen(self, on_invalidate):
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    data = json.loads(message["data"])
+                    if data["origin"] != self.origin:
+                        on_invalidate(data["namespace"], _cache_key(data["key"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Invalidations may have been missed while disconnected, so drop everything local
+                logger.warning(f"Cache invalidation channel lost, resubscribing: {e}")
+                on_invalidate(None, None)
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    async def get(self, namespace: str, key):
+        raw = await self.redis.get(self._key(namespace, key))
+        return json.loads(raw, object_hook=_cache_json_hook) if raw is not None else None
+
+    async def set(self, namespace: str, key, value, ttl: float):
+        raw = json.dumps(value, default=_cache_json_default)
+        await self.redis.set(self._key(namespace, key), raw, px=int(ttl * 1000))
+
+    async def delete(self, namespace: str, key):
+        await self.redis.delete(self._key(namespace, key))
+
+    async def clear(self, namespace: str):
+        keys = [key async for key in self.redis.scan_iter(match=f"{self.prefix}:{namespace}:*", count=500)]
+        if keys:
+            await self.redis.unlink(*keys)
+
+    async def publish(self, namespace: str, key):
+        message = {"origin": self.origin, "namespace": namespace, "key": key}
+        await self.redis.publish(self.channel, json.dumps(message, default=str))
+
+    async def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+        await self.redis.aclose()
+
+def build_cache_backend():
+    if CACHE_BACKEND == "redis":
+        import redis.asyncio as aioredis
+        return RedisCacheBackend(aioredis.from_url(REDIS_URL), CACHE_KEY_PREFIX)
+    return MemoryCacheBackend()
+
+cache_backend = build_cache_backend()
+cache_namespaces: Dict[str, "CacheNamespace"] = {}
+
+# A worker-local TTLCache in front of the shared backend. Values only go to the backend when
+# share_values is set; invalidations are always published so every worker evicts its local copy.
+class CacheNamespace:
+    def __init__(self, name: str, local: TTLCache, share_values: bool = True, on_remote_invalidate=None):
+        self.name = name
+        self.local = local
+        self.share_values = share_values
+        self.on_remote_invalidate = on_remote_invalidate
+        self.shared_hits = 0
+        cache_namespaces[name] = self
+
+    @property
+    def _shared(self) -> bool:
+        return self.local.enabled and self.share_values and cache_backend.shared
+
+    async def get(self, key):
+        value = self.local.get(key)
+        if value is None and self._shared:
+            value = await cache_backend.get(self.name, key)
+            if value is not None:
+                self.shared_hits += 1
+                self.local.set(key, value)
+        return value
+
+    async def set(self, key, value):
+        self.local.set(key, value)
+        if self._shared and value is not None:
+            await cache_backend.set(self.name, key, value, self.local.ttl)
+
+    async def invalidate(self, key):
+        self.local.invalidate(key)
+        if self._shared:
+            await cache_backend.delete(self.name, key)
+        await cache_backend.publish(self.name, key)
+
+    async def clear(self):
+        self.local.clear()
+        if self._shared:
+            await cache_backend.clear(self.name)
+        await cache_backend.publish(self.name, None)
+
+    def evict_local(self, key):
+        if key is None:
+            self.local.clear()
+        else:
+            self.local.invalidate(key)
+        if self.on_remote_invalidate is not None:
+            self.on_remote_invalidate(key)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self.local.stats()
+        stats["backend"] = cache_backend.name if self.share_values else "memory"
+        stats["shared_hits"] = self.shared_hits
+        return stats
+
+def handle_remote_invalidation(namespace: Optional[str], key):
+    targets = cache_namespaces.values() if namespace is None else [cache_namespaces.get(namespace)]
+    for cache in targets:
+        if cache is not None:
+            cache.evict_local(key)
+
+user_cache = CacheNamespace(
+    "users",
+    TTLCache(USER_CACHE_TTL_SECONDS, USER_CACHE_MAX_SIZE, enabled=USER_CACHE_ENABLED),
+    share_values=False
+)
+token_version_cache = CacheNamespace(
+    "token_versions",
+    TTLCache(TOKEN_VERSION_CACHE_TTL_SECONDS, USER_CACHE_MAX_SIZE),
+    share_values=False
+)
+product_cache = CacheNamespace(
+    "products",
+    TTLCache(PRODUCT_CACHE_TTL_SECONDS, PRODUCT_CACHE_MAX_SIZE, enabled=PRODUCT_CACHE_ENABLED),
+    on_remote_invalidate=lambda product_id: schedule_search_refresh(product_id)
+)
+product_query_cache = CacheNamespace(
+    "product_queries",
+    TTLCache(PRODUCT_QUERY_CACHE_TTL_SECONDS, PRODUCT_QUERY_CACHE_MAX_SIZE, enabled=PRODUCT_CACHE_ENABLED)
+)
+category_cache = CacheNamespace(
+    "categories",
+    TTLCache(CATEGORY_CACHE_TTL_SECONDS, 1, enabled=PRODUCT_CACHE_ENABLED)
+)
+catalog_version_cache = CacheNamespace(
+    "catalog_version",
+    TTLCache(CATALOG_VERSION_CACHE_TTL_SECONDS, 1)
+)
+
 # === AUTHENTICATION ===
 def hash_password(password: str) -> str:
     return pwd_context.hash(password)
@@ -125,6 +568,92 @@ def hash_password(password: str) -> str:
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
+# === PASSWORD HASHING POOL ===
+def _timed_call(func, *args):
+    # Runs inside the worker so the start time splits queue wait from hash time
+    started_at = time.time()
+    start = time.perf_counter()
+    result = func(*args)
+    return result, started_at, time.perf_counter() - start
+
+# bcrypt takes ~250ms per call, so it runs on a bounded executor instead of the event loop
+class PasswordHasher:
+    def __init__(self, kind: str, workers: int, max_pending: int):
+        self.kind = kind
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.hash_time_total = 0.0
+        self.hash_time_max = 0.0
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password-hash")
+        return self._executor
+
+    async def _run(self, func, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Server busy, please retry",
+                headers={"Retry-After": "1"}
+            )
+        
+        self.pending += 1
+        submitted_at = time.time()
+        try:
+            loop = asyncio.get_running_loop()
+            result, started_at, hash_time = await loop.run_in_executor(
+                self._get_executor(), _timed_call, func, *args
+            )
+        finally:
+            self.pending -= 1
+        
+        queue_wait = max(0.0, started_at - submitted_at)
+        self.completed += 1
+        self.queue_wait_total += queue_wait
+        self.queue_wait_max = max(self.queue_wait_max, queue_wait)
+        self.hash_time_total += hash_time
+        self.hash_time_max = max(self.hash_time_max, hash_time)
+        return result
+
+    async def hash(self, password: str) -> str:
+        return await self._run(hash_password, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run(verify_password, plain_password, hashed_password)
+
+    def metrics(self) -> Dict[str, Any]:
+        completed = self.completed or 1
+        return {
+            "executor": self.kind,
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "queue_wait_ms_avg": round(self.queue_wait_total / completed * 1000, 3),
+            "queue_wait_ms_max": round(self.queue_wait_max * 1000, 3),
+            "hash_time_ms_avg": round(self.hash_time_total / completed * 1000, 3),
+            "hash_time_ms_max": round(self.hash_time_max * 1000, 3)
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+password_hasher = PasswordHasher(PASSWORD_HASH_EXECUTOR, PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -134,23 +663,82 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, JWT_SECRET, algorithm="HS256")
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+# Every token carries its token version so revocation applies whatever the format; self-contained
+# tokens also carry the role so authorization can skip the users lookup
+def issue_access_token(user: User) -> str:
+    claims = {"sub": user.id, "ver": user.token_version, "iat": datetime.utcnow()}
+    if JWT_SELF_CONTAINED_TOKENS:
+        claims["role"] = user.role
+    return create_access_token(data=claims)
+
+def decode_access_token(token: str) -> Dict[str, Any]:
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
-        user_id = payload.get("sub")
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        
-        user_doc = await db.users.find_one({"id": user_id})
-        if user_doc is None:
-            raise HTTPException(status_code=401, detail="User not found")
-        
-        return User(**user_doc)
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    if payload.get("sub") is None:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return payload
+
+# The password hash is only needed by login, so it never leaves Mongo on authenticated requests
+USER_PROJECTION = {"_id": 0, "password_hash": 0}
 
-async def get_admin_user(current_user: User = Depends(get_current_user)):
+async def load_user(user_id: str) -> User:
+    user = await user_cache.get(user_id)
+    if user is None:
+        user_doc = await db.users.find_one({"id": user_id}, USER_PROJECTION)
+        if user_doc is None:
+            raise HTTPException(status_code=401, detail="User not found")
+        user = User(**user_doc)
+        await user_cache.set(user_id, user)
+    return user
+
+async def get_token_version(user_id: str) -> Optional[int]:
+    version = await token_version_cache.get(user_id)
+    if version is None:
+        user_doc = await db.users.find_one({"id": user_id}, {"_id": 0, "token_version": 1})
+        if user_doc is None:
+            return None
+        version = user_doc.get("token_version", 0)
+        await token_version_cache.set(user_id, version)
+    return version
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    payload = decode_access_token(credentials.credentials)
+    user = await load_user(payload["sub"])
+    # Tokens issued before versioning count as version 0, so any revocation rejects them
+    if payload.get("ver", 0) != user.token_version:
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    return user
+
+# Authorizes from the token alone when it carries role/ver; other tokens fall back to the user record
+async def get_current_claims(credentials: HTTPAuthorizationCredentials = Depends(security)) -> TokenClaims:
+    payload = decode_access_token(credentials.credentials)
+    if "role" not in payload or "ver" not in payload:
+        user = await load_user(payload["sub"])
+        if payload.get("ver", 0) != user.token_version:
+            raise HTTPException(status_code=401, detail="Token has been revoked")
+        return TokenClaims(sub=user.id, role=user.role, ver=user.token_version)
+    
+    claims = TokenClaims(**payload)
+    if await get_token_version(claims.id) != claims.token_version:
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    return claims
+
+# All role/profile writes go through here so cached users never go stale. The role is carried in
+# the token claims, so changing it also bumps token_version and revokes tokens with the old role.
+async def update_user(user_id: str, update: Dict[str, Any]):
+    if any("role" in fields for fields in update.values()):
+        update = {**update, "$inc": {**update.get("$inc", {}), "token_version": 1}}
+    result = await db.users.update_one({"id": user_id}, update)
+    await user_cache.invalidate(user_id)
+    await token_version_cache.invalidate(user_id)
+    return result
+
+async def revoke_user_tokens(user_id: str):
+    return await update_user(user_id, {"$inc": {"token_version": 1}})
+
+async def get_admin_user(current_user: TokenClaims = Depends(get_current_claims)):
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Admin access required")
     return current_user
@@ -159,23 +747,24 @@ async def get_admin_user(current_user: User = Depends(get_current_user)):
 @api_router.post("/auth/register")
 async def register_user(user_data: UserCreate):
     # Check if user exists
-    existing_user = await db.users.find_one({"email": user_data.email})
+    existing_user = await db.users.find_one({"email": user_data.email}, {"_id": 1})
     if existing_user:
         raise HTTPException(status_code=400, detail="Email already registered")
     
     # Create user
     user = User(
         email=user_data.email,
-        password_hash=hash_password(user_data.password),
+        password_hash=await password_hasher.hash(user_data.password),
         full_name=user_data.full_name,
         phone=user_data.phone,
         address=user_data.address
     )
     
     await db.users.insert_one(user.dict())
+    await bump_dashboard_stats(total_users=1)
     
     # Create access token
-    access_token = create_access_token(data={"sub": user.id})
+    access_token = issue_access_token(user)
     
     return {
         "access_token": access_token,
@@ -190,12 +779,12 @@ async def register_user(user_data: UserCreate):
 
 @api_router.post("/auth/login")
 async def login_user(user_data: UserLogin):
-    user_doc = await db.users.find_one({"email": user_data.email})
-    if not user_doc or not verify_password(user_data.password, user_doc["password_hash"]):
+    user_doc = await db.users.find_one({"email": user_data.email}, {"_id": 0})
+    if not user_doc or not await password_hasher.verify(user_data.password, user_doc["password_hash"]):
         raise HTTPException(status_code=400, detail="Invalid email or password")
     
     user = User(**user_doc)
-    access_token = create_access_token(data={"sub": user.id})
+    access_token = issue_access_token(user)
     
     return {
         "access_token": access_token,
@@ -208,160 +797,1697 @@ async def login_user(user_data: UserLogin):
         }
     }
 
+@api_router.post("/auth/logout-all")
+async def logout_all_sessions(current_user: User = Depends(get_current_user)):
+    await revoke_user_tokens(current_user.id)
+    return {"message": "All sessions have been signed out"}
+
+# === PAYMENT GATEWAY ===
+class PaymentGatewayError(Exception):
+    pass
+
+class PaymentGatewayUnavailable(PaymentGatewayError):
+    pass
+
+# Opens after `threshold` consecutive failed calls, then lets a single trial call through after `reset_timeout`
+class CircuitBreaker:
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+    # A trial that ends without an outcome (e.g. the request was cancelled) must not hold the slot
+    def end_trial(self):
+        self._trial_in_flight = False
+
+def payment_signature(order_id: str, payment_id: str, secret: str) -> str:
+    message = f"{order_id}|{payment_id}".encode()
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+def check_payment_signature(order_id, payment_id, signature, secret: str) -> bool:
+    if not all(isinstance(value, str) for value in (order_id, payment_id, signature)):
+        return False
+    return hmac.compare_digest(payment_signature(order_id, payment_id, secret), signature)
+
+class RazorpayGateway:
+    def __init__(self, key_id: str, key_secret: str, base_url: str, timeout: float, max_retries: int, breaker: CircuitBreaker):
+        self.key_id = key_id
+        self.key_secret = key_secret
+        self.base_url = base_url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.breaker = breaker
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # One pooled keep-alive client per worker, created inside the running loop
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                auth=(self.key_id, self.key_secret),
+                timeout=httpx.Timeout(self.timeout, connect=min(self.timeout, 3.0)),
+                limits=httpx.Limits(max_connections=50, max_keepalive_connections=10, keepalive_expiry=30)
+            )
+        return self._client
+
+    # Only failures where the gateway cannot have acted on the request are retried: the connection
+    # was never made, no pooled connection was free, or it answered 429. A read timeout, a dropped
+    # connection or a 5xx may come after POST /orders already created the order, so those fail at once.
+    RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+    async def _request(self, method: str, path: str, **kwargs) -> Dict[str, Any]:
+        trial = self.breaker.state == "half_open"
+        if not self.breaker.allow():
+            raise PaymentGatewayUnavailable("Payment gateway circuit is open")
+        
+        try:
+            return await self._send(method, path, **kwargs)
+        finally:
+            if trial:
+                self.breaker.end_trial()
+
+    async def _send(self, method: str, path: str, **kwargs) -> Dict[str, Any]:
+        error: Exception = PaymentGatewayUnavailable("Payment gateway request failed")
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                # Full jitter so retries from many workers don't arrive in lockstep
+                await asyncio.sleep(random.uniform(0, 0.2 * 2 ** attempt))
+            try:
+                response = await self._get_client().request(method, path, **kwargs)
+            except self.RETRYABLE_ERRORS as e:
+                error = e
+                continue
+            except httpx.TransportError as e:
+                self.breaker.record_failure()
+                raise PaymentGatewayUnavailable(str(e))
+            
+            if response.status_code == 429:
+                error = PaymentGatewayUnavailable("Payment gateway returned 429")
+                continue
+            if response.status_code >= 500:
+                self.breaker.record_failure()
+                raise PaymentGatewayUnavailable(f"Payment gateway returned {response.status_code}")
+            self.breaker.record_success()
+            if response.is_error:
+                raise PaymentGatewayError(f"Payment gateway rejected request: {response.text}")
+            return response.json()
+        
+        self.breaker.record_failure()
+        raise PaymentGatewayUnavailable(str(error))
+
+    async def create_order(self, amount: int, currency: str, receipt: str) -> Dict[str, Any]:
+        return await self._request("POST", "/orders", json={
+            "amount": amount,
+            "currency": currency,
+            "receipt": receipt,
+            "payment_capture": 1
+        })
+
+    def verify_payment_signature(self, order_id, payment_id, signature) -> bool:
+        return check_payment_signature(order_id, payment_id, signature, self.key_secret)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"gateway": "razorpay", "breaker": self.breaker.state, "consecutive_failures": self.breaker.failures}
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+# Local stand-in with the same interface; sign() produces the signature a real checkout would return
+class FakePaymentGateway:
+    def __init__(self, key_secret: str):
+        self.key_secret = key_secret
+        self.orders: Dict[str, Dict[str, Any]] = {}
+
+    async def create_order(self, amount: int, currency: str, receipt: str) -> Dict[str, Any]:
+        order = {
+            "id": f"order_{uuid4().hex[:14]}",
+            "amount": amount,
+            "currency": currency,
+            "receipt": receipt,
+            "status": "created"
+        }
+        self.orders[order["id"]] = order
+        return order
+
+    def sign(self, order_id: str, payment_id: str) -> str:
+        return payment_signature(order_id, payment_id, self.key_secret)
+
+    def verify_payment_signature(self, order_id, payment_id, signature) -> bool:
+        return check_payment_signature(order_id, payment_id, signature, self.key_secret)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"gateway": "fake", "orders": len(self.orders)}
+
+    async def close(self):
+        pass
+
+def build_payment_gateway():
+    if PAYMENT_GATEWAY == "fake":
+        return FakePaymentGateway(RAZORPAY_KEY_SECRET)
+    breaker = CircuitBreaker(PAYMENT_GATEWAY_BREAKER_THRESHOLD, PAYMENT_GATEWAY_BREAKER_RESET_SECONDS)
+    return RazorpayGateway(
+        RAZORPAY_KEY_ID,
+        RAZORPAY_KEY_SECRET,
+        RAZORPAY_API_URL,
+        PAYMENT_GATEWAY_TIMEOUT_SECONDS,
+        PAYMENT_GATEWAY_MAX_RETRIES,
+        breaker
+    )
+
+payment_gateway = build_payment_gateway()
+
+# === INDEXES ===
+# Every query shape the API issues, per collection. Names are fixed so reconciliation can diff them.
+INDEX_REGISTRY: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    ],
+    "products": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel(
+            [("sku", ASCENDING)], name="sku_unique", unique=True,
+            partialFilterExpression={"sku": {"$type": "string"}}
+        ),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)], name="created_at_id"),
+        IndexModel([("category", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="category_created_at_id"),
+    ],
+    "carts": [
+        IndexModel([("user_id", ASCENDING)], name="user_id_unique", unique=True),
+    ],
+    "stock_shards": [
+        IndexModel([("product_id", ASCENDING)], name="product_id"),
+    ],
+    "idempotency_keys": [
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "orders": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING)], name="user_id_created_at"),
+        IndexModel([("razorpay_order_id", ASCENDING)], name="razorpay_order_id"),
+        IndexModel([("payment_status", ASCENDING), ("created_at", DESCENDING)], name="payment_status_created_at"),
+        IndexModel([("order_status", ASCENDING), ("created_at", DESCENDING)], name="order_status_created_at"),
+        IndexModel([("created_at", DESCENDING)], name="created_at"),
+        IndexModel([("stock_status", ASCENDING), ("reservation_expires_at", ASCENDING)], name="stock_status_reservation_expires_at"),
+    ],
+}
+
+async def index_report(database) -> Dict[str, Any]:
+    report = {}
+    for collection_name, models in INDEX_REGISTRY.items():
+        expected = {model.document["name"] for model in models}
+        existing = set(await database[collection_name].index_information())
+        report[collection_name] = {
+            "missing": sorted(expected - existing),
+            "extra": sorted(existing - expected - {"_id_"})
+        }
+    return report
+
+# Idempotent: creating an index that already exists with the same spec is a no-op
+async def ensure_indexes(database) -> Dict[str, Any]:
+    errors: Dict[str, Dict[str, str]] = {}
+    for collection_name, models in INDEX_REGISTRY.items():
+        collection = database[collection_name]
+        try:
+            await collection.create_indexes(models)
+        except OperationFailure:
+            # Retry one by one so a single conflict (e.g. duplicates under a unique key) doesn't block the rest
+            for model in models:
+                try:
+                    await collection.create_indexes([model])
+                except OperationFailure as e:
+                    errors.setdefault(collection_name, {})[model.document["name"]] = str(e)
+    
+    report = await index_report(database)
+    for collection_name, result in report.items():
+        result["errors"] = errors.get(collection_name, {})
+        if result["missing"] or result["errors"]:
+            logger.warning(f"Missing indexes on {collection_name}: {result['missing']} {result['errors']}")
+        if result["extra"]:
+            logger.warning(f"Unregistered indexes on {collection_name}: {result['extra']}")
+    return report
+
+# === DASHBOARD STATS ===
+# Counters kept in stats.dashboard and bumped on every write, so the admin dashboard is a single read
+DASHBOARD_STATS_ID = "dashboard"
+
+async def bump_dashboard_stats(**deltas):
+    await db.stats.update_one({"_id": DASHBOARD_STATS_ID}, {"$inc": deltas}, upsert=True)
+
+async def rebuild_dashboard_stats() -> Dict[str, Any]:
+    facets = (await db.orders.aggregate([{"$facet": {
+        # Same orders place_order counts: those the payment gateway accepted
+        "orders": [{"$match": {"razorpay_order_id": {"$ne": None}}}, {"$count": "count"}],
+        "revenue": [
+            {"$match": {"payment_status": "paid"}},
+            {"$group": {"_id": None, "total": {"$sum": "$total"}}}
+        ]
+    }}]).to_list(1))[0]
+    
+    stats = {
+        "total_products": await db.products.count_documents({}),
+        "total_orders": facets["orders"][0]["count"] if facets["orders"] else 0,
+        "total_users": await db.users.count_documents({"role": "customer"}),
+        "total_revenue": facets["revenue"][0]["total"] if facets["revenue"] else 0
+    }
+    await db.stats.replace_one({"_id": DASHBOARD_STATS_ID}, stats, upsert=True)
+    return stats
+
+# === PRODUCT SEARCH ===
+SEARCH_FIELD_WEIGHTS = {"name": 3.0, "category": 2.0, "description": 1.0}
+SEARCH_PREFIX_PENALTY = 0.5
+SEARCH_MIN_PREFIX_LENGTH = 2  # single letters would expand to most of the vocabulary
+SEARCH_PROJECTION = {"_id": 0, "id": 1, "name": 1, "description": 1, "category": 1}
+_search_token_re = re.compile(r"\w+")
+
+def tokenize(text: Optional[str]) -> List[str]:
+    return _search_token_re.findall(text.lower()) if text else []
+
+# Inverted index over name/category/description; every query term is matched as a prefix for typeahead
+class ProductSearchIndex:
+    def __init__(self):
+        self.ready = False
+        self.catalog_version: Optional[int] = None  # catalog version this index reflects
+        self.generation = 0  # bumped by every rebuild, so cached search pages from before it are not reused
+        self._postings: Dict[str, Dict[str, float]] = {}  # token -> {product_id: field weight}
+        self._vocabulary: List[str] = []  # sorted tokens, for prefix lookups
+        self._documents: Dict[str, tuple] = {}  # product_id -> (tokens, category)
+        self._rebuilding = False
+        self._rebuild_again = False
+        self._pending: Optional[List[tuple]] = None  # writes made while a rebuild is loading
+
+    def add(self, product: Dict[str, Any]):
+        if self._pending is not None:
+            self._pending.append(("add", product))
+        product_id = product["id"]
+        self._remove(product_id)
+        
+        weights: Dict[str, float] = {}
+        for field, weight in SEARCH_FIELD_WEIGHTS.items():
+            for token in tokenize(product.get(field)):
+                weights[token] = weights.get(token, 0.0) + weight
+        
+        for token, weight in weights.items():
+            posting = self._postings.get(token)
+            if posting is None:
+                posting = self._postings[token] = {}
+                bisect.insort(self._vocabulary, token)
+            posting[product_id] = weight
+        self._documents[product_id] = (tuple(weights), product.get("category"))
+
+    def remove(self, product_id: str):
+        if self._pending is not None:
+            self._pending.append(("remove", product_id))
+        self._remove(product_id)
+
+    def _remove(self, product_id: str):
+        entry = self._documents.pop(product_id, None)
+        if entry is None:
+            return
+        for token in entry[0]:
+            posting = self._postings[token]
+            posting.pop(product_id, None)
+            if not posting:
+                del self._postings[token]
+                del self._vocabulary[bisect.bisect_left(self._vocabulary, token)]
+
+    def _expand(self, term: str) -> List[str]:
+        if len(term) < SEARCH_MIN_PREFIX_LENGTH:
+            return [term] if term in self._postings else []
+        tokens = []
+        i = bisect.bisect_left(self._vocabulary, term)
+        while i < len(self._vocabulary) and self._vocabulary[i].startswith(term):
+            tokens.append(self._vocabulary[i])
+            i += 1
+        return tokens
+
+    def _score_term(self, term: str) -> Dict[str, float]:
+        total = len(self._documents) or 1
+        scores: Dict[str, float] = {}
+        for token in self._expand(term):
+            posting = self._postings[token]
+            idf = math.log(1 + total / len(posting))
+            factor = idf if token == term else idf * SEARCH_PREFIX_PENALTY
+            for product_id, weight in posting.items():
+                score = weight * factor
+                if score > scores.get(product_id, 0.0):
+                    scores[product_id] = score
+        return scores
+
+    # Returns (product_id, score) pairs matching every term, best first
+    def search(self, query: str, category: Optional[str] = None) -> List[tuple]:
+        terms = tokenize(query)
+        if not terms:
+            return []
+        
+        per_term = sorted((self._score_term(term) for term in dict.fromkeys(terms)), key=len)
+        results = per_term[0]
+        for scores in per_term[1:]:
+            results = {pid: score + scores[pid] for pid, score in results.items() if pid in scores}
+            if not results:
+                return []
+        
+        if category:
+            results = {pid: score for pid, score in results.items() if self._documents[pid][1] == category}
+        return sorted(results.items(), key=lambda item: (-item[1], item[0]))
+
+    # Loads a fresh index and swaps it in, so searches keep using the current one meanwhile. Writes
+    # made during the load are replayed onto the fresh index before the swap. Only one rebuild runs
+    # at a time: asking again while one is loading makes it load once more when done, and returns
+    # False straight away.
+    async def rebuild(self, collection) -> bool:
+        if self._rebuilding:
+            self._rebuild_again = True
+            return False
+        self._rebuilding = True
+        try:
+            while True:
+                self._rebuild_again = False
+                self._pending = []
+                fresh = ProductSearchIndex()
+                async for product in collection.find({}, SEARCH_PROJECTION):
+                    fresh.add(product)
+                for operation, argument in self._pending:
+                    getattr(fresh, operation)(argument)
+                self._postings, self._vocabulary, self._documents = fresh._postings, fresh._vocabulary, fresh._documents
+                self._pending = None
+                self.generation += 1
+                self.ready = True
+                if not self._rebuild_again:
+                    return True
+        finally:
+            self._rebuilding = False
+            self._pending = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": SEARCH_MODE,
+            "ready": self.ready,
+            "catalog_version": self.catalog_version,
+            "generation": self.generation,
+            "documents": len(self._documents),
+            "tokens": len(self._vocabulary)
+        }
+
+search_index = ProductSearchIndex()
+
+# Another worker changed this product; re-read it so the local index matches
+async def refresh_search_entry(product_id: str):
+    product = await db.products.find_one({"id": product_id}, SEARCH_PROJECTION)
+    if product is None:
+        search_index.remove(product_id)
+    else:
+        search_index.add(product)
+
+_search_refresh_tasks = set()
+
+def schedule_search_refresh(product_id: Optional[str]):
+    if SEARCH_MODE != "index":
+        return
+    if product_id is None:
+        task = asyncio.create_task(search_index.rebuild(db.products))
+    else:
+        task = asyncio.create_task(refresh_search_entry(product_id))
+    # Keep a reference until done so the task isn't garbage collected mid-flight
+    _search_refresh_tasks.add(task)
+    task.add_done_callback(_search_refresh_tasks.discard)
+
+# Without a shared cache backend other workers' product writes never reach this index, so it is
+# rebuilt whenever the shared catalog version moves past the one it reflects. The version is claimed
+# before the rebuild reads anything, so writes landing during the rebuild trigger another one. With
+# a shared backend those writes already arrive per product through product_cache's invalidations.
+def sync_search_index(catalog_version: int):
+    if SEARCH_MODE != "index" or search_index.catalog_version == catalog_version:
+        return
+    search_index.catalog_version = catalog_version
+    if not cache_backend.shared:
+        schedule_search_refresh(None)
+
+# === PAGINATION ===
+# Catalog pages are ordered by (created_at, id); search pages by (-score, id)
+PRODUCT_SORT = [("created_at", 1), ("id", 1)]
+
+def encode_cursor(data: Dict[str, Any]) -> str:
+    raw = json.dumps(data, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str, kind: str) -> Dict[str, Any]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if data.get("k") != kind or not isinstance(data.get("i"), str):
+            raise ValueError(cursor)
+        return data
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def product_cursor(product: Dict[str, Any]) -> str:
+    return encode_cursor({"k": "c", "t": product["created_at"].isoformat(), "i": product["id"]})
+
+def product_cursor_query(cursor: str) -> Dict[str, Any]:
+    data = decode_cursor(cursor, "c")
+    try:
+        created_at = datetime.fromisoformat(data["t"])
+    except (KeyError, TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return {"$or": [
+        {"created_at": {"$gt": created_at}},
+        {"created_at": created_at, "id": {"$gt": data["i"]}}
+    ]}
+
+def search_page(ranked: List[tuple], cursor: Optional[str], skip: int, limit: int) -> tuple:
+    start = skip
+    if cursor:
+        data = decode_cursor(cursor, "s")
+        if not isinstance(data.get("s"), (int, float)):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        keys = [(-score, product_id) for product_id, score in ranked]
+        start = bisect.bisect_right(keys, (-data["s"], data["i"]))
+    
+    page = ranked[start:start + limit]
+    next_cursor = None
+    if len(page) == limit and start + limit < len(ranked):
+        last_id, last_score = page[-1]
+        next_cursor = encode_cursor({"k": "s", "s": last_score, "i": last_id})
+    return [product_id for product_id, _ in page], next_cursor
+
+# === PRODUCT CACHE ===
+# Read-through caches; the admin product endpoints invalidate them on every write
+async def get_product_doc(product_id: str) -> Optional[Dict[str, Any]]:
+    product = await product_cache.get(product_id)
+    if product is None:
+        product = await db.products.find_one({"id": product_id}, {"_id": 0})
+        await product_cache.set(product_id, product)
+    return product
+
+async def get_product_docs(product_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    found = {}
+    for product_id in product_ids:
+        product = await product_cache.get(product_id)
+        if product is not None:
+            found[product_id] = product
+    
+    missing = [product_id for product_id in product_ids if product_id not in found]
+    if missing:
+        async for product in db.products.find({"id": {"$in": missing}}, {"_id": 0}):
+            await product_cache.set(product["id"], product)
+            found[product["id"]] = product
+    return found
+
+async def invalidate_product(product_id: str):
+    await product_cache.invalidate(product_id)
+    await product_query_cache.clear()
+    await bump_catalog_version()
+
+async def query_products(category, search, limit, skip, cursor, fields=None) -> tuple:
+    if search and SEARCH_MODE == "index" and search_index.ready:
+        ranked = search_index.search(search, category=category)
+        page_ids, next_cursor = search_page(ranked, cursor, skip, limit)
+        by_id = await get_product_docs(page_ids)
+        return [select_fields(by_id[product_id], fields) for product_id in page_ids if product_id in by_id], next_cursor
+    
+    filters = []
+    if category:
+        filters.append({"category": category})
+    if search:
+        filters.append({"$or": [
+            {"name": {"$regex": search, "$options": "i"}},
+            {"description": {"$regex": search, "$options": "i"}}
+        ]})
+    if cursor:
+        filters.append(product_cursor_query(cursor))
+    query = {"$and": filters} if len(filters) > 1 else (filters[0] if filters else {})
+    
+    # created_at is always fetched because the next cursor is built from it
+    # Listing pages are cached and served with a max-age anyway, so they may come from a secondary
+    products_cursor = catalog_db.products.find(query, fields_projection(fields, "created_at")).sort(PRODUCT_SORT)
+    if not cursor:
+        products_cursor = products_cursor.skip(skip)
+    products = await products_cursor.limit(limit).to_list(limit)
+    next_cursor = product_cursor(products[-1]) if products and len(products) == limit else None
+    return [select_fields(product, fields) for product in products], next_cursor
+
+# === CONDITIONAL REQUESTS ===
+# Catalog ETags come from a version counter in stats.catalog that every product write bumps, plus
+# a fingerprint of the live stock shown (stock writes don't touch the catalog; see INVENTORY).
+# Stock has no modification time, so responses showing it are validated by ETag alone.
+CATALOG_VERSION_ID = "catalog"
+CATALOG_CACHE_CONTROL = f"public, max-age={CATALOG_CACHE_MAX_AGE}, stale-while-revalidate={CATALOG_STALE_WHILE_REVALIDATE}"
+
+async def get_catalog_version() -> Dict[str, Any]:
+    catalog = await catalog_version_cache.get("current")
+    if catalog is None:
+        catalog = await db.stats.find_one({"_id": CATALOG_VERSION_ID}, {"_id": 0}) or {"version": 0}
+        await catalog_version_cache.set("current", catalog)
+    sync_search_index(catalog["version"])
+    return catalog
+
+def stock_fingerprint(products: List[Dict[str, Any]]) -> str:
+    stock = [(product["id"], product["stock"]) for product in products if "stock" in product]
+    return hashlib.sha1(json.dumps(stock).encode()).hexdigest()[:8] if stock else ""
+
+async def bump_catalog_version():
+    catalog = await db.stats.find_one_and_update(
+        {"_id": CATALOG_VERSION_ID},
+        {"$inc": {"version": 1}, "$set": {"updated_at": datetime.utcnow()}},
+        projection={"_id": 0, "version": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    # Callers update the local search index themselves, so if nobody else wrote in between it is current
+    if search_index.catalog_version == catalog["version"] - 1:
+        search_index.catalog_version = catalog["version"]
+    await catalog_version_cache.invalidate("current")
+
+def _etag_value(etag: str) -> str:
+    return etag[2:] if etag.startswith("W/") else etag
+
+def is_not_modified(request: Request, etag: str, last_modified: Optional[datetime]) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # If-None-Match uses weak comparison and takes precedence over If-Modified-Since
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or _etag_value(etag) in {_etag_value(tag) for tag in tags}
+    
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is not None:
+            since = since.astimezone(timezone.utc).replace(tzinfo=None)
+        return last_modified.replace(microsecond=0) <= since
+    return False
+
+def catalog_cache_headers(etag: str, last_modified: Optional[datetime]) -> Dict[str, str]:
+    headers = {"ETag": etag, "Cache-Control": CATALOG_CACHE_CONTROL}
+    if last_modified is not None:
+        headers["Last-Modified"] = format_datetime(last_modified.replace(tzinfo=timezone.utc), usegmt=True)
+    return headers
+
+# Returns a 304 when the client copy is current; otherwise sets the validators on the real response
+def conditional_response(request: Request, response: Response, etag: str, last_modified: Optional[datetime]) -> Optional[Response]:
+    headers = catalog_cache_headers(etag, last_modified)
+    if is_not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
+# === COMPRESSION ===
+# Per-response levels favour speed; precompressed catalog payloads are built once per catalog
+# version, so they can afford stronger settings
+COMPRESSION_LEVELS = {"zstd": 3, "br": 4, "gzip": 6}
+PRECOMPRESSION_LEVELS = {"zstd": 12, "br": 9, "gzip": 9}
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+SUPPORTED_ENCODINGS = [
+    encoding for encoding in COMPRESSION_ENCODINGS
+    if encoding == "gzip" or (encoding == "br" and brotli) or (encoding == "zstd" and zstandard)
+]
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    if not COMPRESSION_ENABLED or not accept_encoding:
+        return None
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name.strip().lower()] = quality
+    
+    # Highest q wins; ties go to the earlier entry in COMPRESSION_ENCODINGS
+    best, best_quality = None, 0.0
+    for encoding in SUPPORTED_ENCODINGS:
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+def compress_body(encoding: str, data: bytes, level: int) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=level)
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+# Incremental compressor for streamed bodies; every chunk is flushed so clients see rows as they arrive
+class StreamCompressor:
+    def __init__(self, encoding: str):
+        level = COMPRESSION_LEVELS[encoding]
+        if encoding == "br":
+            compressor = brotli.Compressor(quality=level)
+            self._compress, self._flush, self._finish = compressor.process, compressor.flush, compressor.finish
+        elif encoding == "zstd":
+            compressor = zstandard.ZstdCompressor(level=level).compressobj()
+            self._compress = compressor.compress
+            self._flush = lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+            self._finish = compressor.flush
+        else:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+            self._compress = compressor.compress
+            self._flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+            self._finish = compressor.flush
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        return self._compress(data) + (self._finish() if final else self._flush())
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding"))
+        if encoding is None:
+            return await self.app(scope, receive, send)
+        
+        start_message = None
+        compressor = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start_message, compressor, passthrough
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                return await send(message)
+            
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if compressor is not None:
+                return await send({"type": "http.response.body", "body": compressor.compress(body, not more_body), "more_body": more_body})
+            
+            # First body message: decide from the headers and, for complete bodies, the size
+            headers = MutableHeaders(raw=start_message["headers"])
+            if (
+                "content-encoding" in headers
+                or start_message["status"] < 200 or start_message["status"] in (204, 304)
+                or not headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)
+                or (not more_body and len(body) < self.minimum_size)
+            ):
+                passthrough = True
+                await send(start_message)
+                return await send(message)
+            
+            headers["Content-Encoding"] = encoding
+            headers.add_vary_header("Accept-Encoding")
+            # The encoded bytes differ from the identity representation, so a strong validator becomes weak
+            etag = headers.get("etag")
+            if etag and not etag.startswith("W/"):
+                headers["ETag"] = f"W/{etag}"
+            if more_body:
+                del headers["Content-Length"]
+                compressor = StreamCompressor(encoding)
+                body = compressor.compress(body, False)
+            else:
+                body = compress_body(encoding, body, COMPRESSION_LEVELS[encoding])
+                headers["Content-Length"] = str(len(body))
+            await send(start_message)
+            await send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
+
+# Encoded listing bodies keyed by (ETag, encoding); the ETag carries the catalog version, so entries
+# never need invalidating and each page is serialized and compressed once per version
+catalog_payload_cache = TTLCache(PRODUCT_QUERY_CACHE_TTL_SECONDS, CATALOG_PAYLOAD_CACHE_MAX_SIZE, enabled=PRODUCT_CACHE_ENABLED)
+
+def encode_payload(body: bytes, encoding: Optional[str]) -> tuple:
+    if encoding is None or len(body) < COMPRESSION_MIN_SIZE:
+        return body, None
+    return compress_body(encoding, body, PRECOMPRESSION_LEVELS[encoding]), encoding
+
+def payload_response(content: bytes, content_encoding: Optional[str], response: Response) -> Response:
+    headers = dict(response.headers)
+    if COMPRESSION_ENABLED:
+        headers["Vary"] = "Accept-Encoding"
+    if content_encoding:
+        headers["Content-Encoding"] = content_encoding
+    return Response(content=content, media_type="application/json", headers=headers)
+
+# Default response class for the app. Returned dicts reach it already run through jsonable_encoder,
+# which orjson dumps faster than json.dumps; a model handed over directly (model_response) is dumped
+# by pydantic-core without building an intermediate dict.
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, BaseModel):
+            return content.__pydantic_serializer__.to_json(content)
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+def model_response(model: BaseModel, response: Response) -> Response:
+    return FastJSONResponse(model, headers=dict(response.headers))
+
+# FastAPI would validate a returned model list against response_model a second time and then
+# walk it through jsonable_encoder; returning the bytes directly skips both
+def json_list_response(adapter: TypeAdapter, docs: List[Dict[str, Any]], response: Response) -> Response:
+    content = adapter.dump_json(adapter.validate_python(docs))
+    return Response(content=content, media_type="application/json", headers=dict(response.headers))
+
 # === PRODUCT ROUTES ===
 @api_router.get("/products", response_model=List[Product])
 async def get_products(
+    request: Request,
+    response: Response,
     category: Optional[str] = None,
     search: Optional[str] = None,
-    limit: int = 20,
-    skip: int = 0
+    limit: int = Query(20, ge=1, le=100),
+    skip: int = Query(0, ge=0),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None
 ):
-    query = {}
-    if category:
-        query["category"] = category
-    if search:
-        query["$or"] = [
-            {"name": {"$regex": search, "$options": "i"}},
-            {"description": {"$regex": search, "$options": "i"}}
-        ]
+    # Pass X-Next-Cursor back as ?cursor= for the next page; skip keeps working for old clients
+    selected_fields = parse_fields(fields, Product, PRODUCT_FIELD_PRESETS)
+    cache_key = (category, search, limit, skip, cursor, tuple(selected_fields or ()), search_index.generation if search else 0)
+    catalog = await get_catalog_version()
+    query_hash = hashlib.sha1(json.dumps(cache_key).encode()).hexdigest()[:16]
+    
+    # Cached pages don't go stale with every sale: their stock is replaced with live stock here
+    page = await product_query_cache.get(cache_key)
+    if page is None:
+        page = await query_products(category, search, limit, skip, cursor, selected_fields)
+        await product_query_cache.set(cache_key, page)
+    products, next_cursor = page
+    products = await with_live_stock(products)
+    
+    stock_tag = stock_fingerprint(products)
+    etag = f'W/"c{catalog["version"]}-{query_hash}{"-" + stock_tag if stock_tag else ""}"'
+    not_modified = conditional_response(request, response, etag, None if stock_tag else catalog.get("updated_at"))
+    if not_modified is not None:
+        return not_modified
     
-    products = await db.products.find(query).skip(skip).limit(limit).to_list(limit)
-    return [Product(**product) for product in products]
+    payload_key = (etag, negotiate_encoding(request.headers.get("accept-encoding")))
+    payload = catalog_payload_cache.get(payload_key)
+    if payload is None:
+        adapter = sparse_list_adapter if selected_fields else product_list_adapter
+        body = adapter.dump_json(adapter.validate_python(products))
+        payload = encode_payload(body, payload_key[1])
+        catalog_payload_cache.set(payload_key, payload)
+    
+    content, content_encoding = payload
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return payload_response(content, content_encoding, response)
 
 @api_router.get("/products/{product_id}", response_model=Product)
-async def get_product(product_id: str):
-    product_doc = await db.products.find_one({"id": product_id})
+async def get_product(product_id: str, request: Request, response: Response):
+    product_doc = await get_product_doc(product_id)
     if not product_doc:
         raise HTTPException(status_code=404, detail="Product not found")
-    return Product(**product_doc)
+    
+    # The ETag covers the live stock as well, since stock writes leave updated_at alone
+    product_doc = (await with_live_stock([product_doc]))[0]
+    updated_at = product_doc.get("updated_at")
+    etag = f'"p-{product_id}-{int(updated_at.timestamp() * 1000) if updated_at else 0}-{product_doc.get("stock", 0)}"'
+    not_modified = conditional_response(request, response, etag, None)
+    if not_modified is not None:
+        return not_modified
+    return model_response(Product(**product_doc), response)
 
 @api_router.post("/products", response_model=Product)
-async def create_product(product_data: ProductCreate, admin_user: User = Depends(get_admin_user)):
+async def create_product(product_data: ProductCreate, admin_user: TokenClaims = Depends(get_admin_user)):
     product = Product(**product_data.dict())
-    await db.products.insert_one(product.dict())
+    try:
+        await db.products.insert_one(product.dict())
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="A product with this SKU already exists")
+    await bump_dashboard_stats(total_products=1)
+    await bump_category_count(product.category, 1)
+    search_index.add(product.dict())
+    await invalidate_product(product.id)
     return product
 
 @api_router.put("/products/{product_id}", response_model=Product)
-async def update_product(product_id: str, product_data: ProductCreate, admin_user: User = Depends(get_admin_user)):
+async def update_product(product_id: str, product_data: ProductCreate, admin_user: TokenClaims = Depends(get_admin_user)):
     update_data = product_data.dict()
     update_data["updated_at"] = datetime.utcnow()
     
-    result = await db.products.update_one(
-        {"id": product_id},
-        {"$set": update_data}
-    )
+    try:
+        previous_product = await db.products.find_one_and_update(
+            {"id": product_id},
+            {"$set": update_data},
+            projection={"_id": 0},
+            return_document=ReturnDocument.BEFORE
+        )
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="A product with this SKU already exists")
     
-    if result.matched_count == 0:
+    if previous_product is None:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    updated_product = await db.products.find_one({"id": product_id})
+    if previous_product.get("category") != update_data["category"]:
+        await bump_category_count(previous_product.get("category"), -1)
+        await bump_category_count(update_data["category"], 1)
+    
+    # A sharded product keeps its stock in the sub-counters, so the new level is spread over them
+    if previous_product.get("stock_shards"):
+        await db.products.update_one({"id": product_id}, {"$set": {"stock": 0}})
+        await distribute_stock(product_id, previous_product["stock_shards"], update_data["stock"])
+    
+    updated_product = {**previous_product, **update_data}
+    search_index.add(updated_product)
+    await invalidate_product(product_id)
     return Product(**updated_product)
 
 @api_router.delete("/products/{product_id}")
-async def delete_product(product_id: str, admin_user: User = Depends(get_admin_user)):
-    result = await db.products.delete_one({"id": product_id})
-    if result.deleted_count == 0:
+async def delete_product(product_id: str, admin_user: TokenClaims = Depends(get_admin_user)):
+    deleted_product = await db.products.find_one_and_delete({"id": product_id}, projection={"_id": 0, "category": 1})
+    if deleted_product is None:
         raise HTTPException(status_code=404, detail="Product not found")
+    await bump_dashboard_stats(total_products=-1)
+    await bump_category_count(deleted_product.get("category"), -1)
+    search_index.remove(product_id)
+    await invalidate_product(product_id)
     return {"message": "Product deleted successfully"}
 
+# === BULK IMPORT ===
+# Rows are read from the request stream, validated and upserted one chunk at a time, so memory is
+# bounded by IMPORT_CHUNK_SIZE rather than the upload. Counters, caches and the search index are
+# refreshed once when the import finishes.
+# Lines end at "\n" only (str.splitlines would also split on U+2028 and friends inside JSON strings);
+# a "\r" before it is dropped, even when the CRLF straddles two chunks
+async def iter_lines(request: Request):
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    async for chunk in request.stream():
+        pending += decoder.decode(chunk)
+        lines = pending.split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line[:-1] if line.endswith("\r") else line
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending[:-1] if pending.endswith("\r") else pending
+
+async def iter_ndjson_rows(request: Request):
+    row = 0
+    async for line in iter_lines(request):
+        row += 1
+        if not line.strip():
+            continue
+        try:
+            yield row, json.loads(line)
+        except ValueError as e:
+            yield row, e
+
+async def iter_csv_rows(request: Request):
+    header = None
+    record: List[str] = []
+    row = 0
+    async for line in iter_lines(request):
+        # A quoted cell may span lines; the record is complete once its quotes balance
+        record.append(line)
+        if "".join(record).count('"') % 2:
+            continue
+        cells = next(csv.reader(["\n".join(record)]), [])
+        record = []
+        if header is None:
+            header = [cell.strip() for cell in cells]
+            continue
+        row += 1
+        if any(cell.strip() for cell in cells):
+            # Empty cells mean "not provided" so optional fields fall back to their defaults
+            yield row, {key: value for key, value in zip(header, cells) if value != ""}
+    if record:
+        yield row + 1, ValueError("Unterminated quoted field")
+
+async def iter_json_rows(request: Request):
+    try:
+        rows = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Request body is not valid JSON")
+    if not isinstance(rows, list):
+        raise HTTPException(status_code=400, detail="Expected a JSON array of products")
+    for row, item in enumerate(rows, start=1):
+        yield row, item
+
+IMPORT_READERS = {
+    "application/json": iter_json_rows,
+    "application/x-ndjson": iter_ndjson_rows,
+    "application/jsonl": iter_ndjson_rows,
+    "text/csv": iter_csv_rows,
+}
+
+# Only the fields a row actually gives are written to an existing product; defaults (e.g. stock 0)
+# apply to new ones alone, so an update file without a stock column leaves stock untouched
+def import_operation(item: ProductImportRow, now: datetime) -> UpdateOne:
+    fields = item.dict(exclude={"id"}, exclude_unset=True, exclude_none=True)
+    fields["updated_at"] = now
+    on_insert = {key: value for key, value in item.dict(exclude={"id"}, exclude_none=True).items() if key not in fields}
+    on_insert["created_at"] = now
+    if item.id:
+        selector = {"id": item.id}
+    elif item.sku:
+        selector = {"sku": item.sku}
+        on_insert["id"] = str(uuid4())
+    else:
+        selector = {"id": str(uuid4())}
+    return UpdateOne(selector, {"$set": fields, "$setOnInsert": on_insert}, upsert=True)
+
+def import_error_message(error) -> str:
+    if isinstance(error, ValidationError):
+        return "; ".join(f"{'.'.join(map(str, err['loc'])) or 'row'}: {err['msg']}" for err in error.errors())
+    if isinstance(error, DuplicateKeyError) or (isinstance(error, dict) and error.get("code") == 11000):
+        return "Duplicate SKU"
+    if isinstance(error, dict):
+        return error.get("errmsg", "Write failed")
+    return str(error)
+
+class ProductImport:
+    def __init__(self):
+        self.received = 0
+        self.inserted = 0
+        self.updated = 0
+        self.failed = 0
+        self.errors: List[Dict[str, Any]] = []
+
+    def fail(self, row: int, error):
+        self.failed += 1
+        if len(self.errors) < IMPORT_MAX_ERRORS:
+            self.errors.append({"row": row, "error": import_error_message(error)})
+
+    async def write_chunk(self, chunk: List[tuple]):
+        now = datetime.utcnow()
+        rows, operations = [], []
+        stock_by_id, stock_by_sku = {}, {}
+        for row, item in chunk:
+            try:
+                if isinstance(item, Exception):
+                    raise item
+                product = ProductImportRow.model_validate(item)
+                operations.append(import_operation(product, now))
+                rows.append(row)
+                if "stock" in product.model_fields_set:
+                    if product.id:
+                        stock_by_id[product.id] = product.stock
+                    elif product.sku:
+                        stock_by_sku[product.sku] = product.stock
+            except ValueError as e:
+                self.fail(row, e)
+        if not operations:
+            return
+        
+        try:
+            result = (await db.products.bulk_write(operations, ordered=False)).bulk_api_result
+        except BulkWriteError as e:
+            result = e.details
+            for write_error in result.get("writeErrors", []):
+                self.fail(rows[write_error["index"]], write_error)
+        self.inserted += result.get("nUpserted", 0)
+        self.updated += result.get("nMatched", 0)
+        if stock_by_id or stock_by_sku:
+            await self.spread_sharded_stock(stock_by_id, stock_by_sku)
+
+    # Same as PUT /products/{id}: a sharded product's imported stock is the new total, spread over
+    # its shards, rather than an amount on top of them. New products are never sharded.
+    async def spread_sharded_stock(self, stock_by_id: Dict[str, int], stock_by_sku: Dict[str, int]):
+        query = {
+            "$or": [{"id": {"$in": list(stock_by_id)}}, {"sku": {"$in": list(stock_by_sku)}}],
+            "stock_shards": {"$gt": 0}
+        }
+        async for product in db.products.find(query, {"_id": 0, "id": 1, "sku": 1, "stock_shards": 1}):
+            stock = stock_by_id[product["id"]] if product["id"] in stock_by_id else stock_by_sku[product["sku"]]
+            await db.products.update_one({"id": product["id"]}, {"$set": {"stock": 0}})
+            await distribute_stock(product["id"], product["stock_shards"], stock)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "received": self.received,
+            "inserted": self.inserted,
+            "updated": self.updated,
+            "failed": self.failed,
+            "errors": self.errors,
+            "errors_truncated": self.failed > len(self.errors)
+        }
+
+@api_router.post("/admin/products/bulk")
+async def bulk_import_products(request: Request, admin_user: TokenClaims = Depends(get_admin_user)):
+    content_type = request.headers.get("content-type", "application/json").split(";")[0].strip().lower()
+    reader = IMPORT_READERS.get(content_type)
+    if reader is None:
+        raise HTTPException(status_code=415, detail=f"Unsupported content type, expected one of: {', '.join(IMPORT_READERS)}")
+    
+    result = ProductImport()
+    chunk = []
+    async for row, item in reader(request):
+        result.received += 1
+        chunk.append((row, item))
+        if len(chunk) == IMPORT_CHUNK_SIZE:
+            await result.write_chunk(chunk)
+            chunk = []
+    if chunk:
+        await result.write_chunk(chunk)
+    
+    if result.inserted or result.updated:
+        await bump_dashboard_stats(total_products=result.inserted)
+        # Upserts can move products between categories, so recount instead of tracking per-row deltas
+        await reconcile_category_counts()
+        await product_cache.clear()
+        await product_query_cache.clear()
+        await bump_catalog_version()
+        schedule_search_refresh(None)
+    return result.summary()
+
+# === CART UPDATES ===
+# Cart changes are update pipelines applied with one find_one_and_update, so concurrent
+# requests from several tabs can't overwrite each other and the total is recomputed server-side
+def _cart_upsert_line_stage(product_id: str, price: float, existing_quantity, new_quantity: int) -> Dict[str, Any]:
+    product_id_expr = {"$literal": product_id}
+    return {"$set": {"items": {"$cond": [
+        {"$in": [product_id_expr, "$items.product_id"]},
+        {"$map": {
+            "input": "$items",
+            "as": "item",
+            "in": {"$cond": [
+                {"$eq": ["$$item.product_id", product_id_expr]},
+                {"$mergeObjects": ["$$item", {"quantity": existing_quantity}]},
+                "$$item"
+            ]}
+        }},
+        {"$concatArrays": ["$items", [{"product_id": product_id_expr, "quantity": new_quantity, "price": price}]]}
+    ]}}}
+
+def cart_add_stage(product_id: str, quantity: int, price: float) -> Dict[str, Any]:
+    return _cart_upsert_line_stage(product_id, price, {"$add": ["$$item.quantity", quantity]}, quantity)
+
+def cart_set_stage(product_id: str, quantity: int, price: float) -> Dict[str, Any]:
+    return _cart_upsert_line_stage(product_id, price, quantity, quantity)
+
+def cart_remove_stage(product_id: str) -> Dict[str, Any]:
+    return {"$set": {"items": {"$filter": {
+        "input": "$items",
+        "as": "item",
+        "cond": {"$ne": ["$$item.product_id", {"$literal": product_id}]}
+    }}}}
+
+async def apply_cart_update(user_id: str, stages: List[Dict[str, Any]], upsert: bool = True) -> Optional[Dict[str, Any]]:
+    pipeline = [
+        {"$set": {
+            "id": {"$ifNull": ["$id", str(uuid4())]},
+            "items": {"$ifNull": ["$items", []]}
+        }},
+        *stages,
+        {"$set": {
+            "total": {"$sum": {"$map": {
+                "input": "$items",
+                "as": "item",
+                "in": {"$multiply": ["$$item.quantity", "$$item.price"]}
+            }}},
+            "updated_at": datetime.utcnow()
+        }}
+    ]
+    for attempt in range(2):
+        try:
+            return await db.carts.find_one_and_update(
+                {"user_id": user_id},
+                pipeline,
+                projection={"_id": 0},
+                upsert=upsert,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # Another request created the cart first; the retry updates it in place
+            if attempt:
+                raise
+
+# === IDEMPOTENCY ===
+# A request carrying an Idempotency-Key claims {_id: "<scope>:<user>:<key>"} in idempotency_keys
+# before running. The final response is stored on that record and replayed to any retry with the
+# same key; retries that arrive while the first is still running wait for it. Server errors and
+# transient conflicts (e.g. a 409 for stock that may come back) release the claim so the retry
+# runs again. Expired records are removed by the TTL index.
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+IDEMPOTENCY_TRANSIENT_STATUS_CODES = {408, 409, 425, 429}
+_idempotency_inflight: Dict[str, asyncio.Event] = {}
+
+# Handler results are stored before FastAPI encodes them, so they can still hold models
+def _orjson_default(value):
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def request_fingerprint(payload: Any) -> str:
+    return hashlib.sha256(orjson.dumps(payload, default=_orjson_default, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+async def claim_idempotency_key(record_id: str, fingerprint: str) -> bool:
+    now = datetime.utcnow()
+    try:
+        await db.idempotency_keys.insert_one({
+            "_id": record_id,
+            "fingerprint": fingerprint,
+            "status": "in_progress",
+            "locked_until": now + timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS),
+            "expires_at": now + timedelta(seconds=IDEMPOTENCY_TTL_SECONDS)
+        })
+        return True
+    except DuplicateKeyError:
+        return False
+
+# A claim whose owner died is taken over once its lock lapses; the lock value makes the takeover atomic
+async def take_over_idempotency_key(record_id: str, locked_until: datetime) -> bool:
+    result = await db.idempotency_keys.update_one(
+        {"_id": record_id, "status": "in_progress", "locked_until": locked_until},
+        {"$set": {"locked_until": datetime.utcnow() + timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)}}
+    )
+    return result.modified_count == 1
+
+async def complete_idempotency_key(record_id: str, status_code: int, content: Any):
+    await db.idempotency_keys.update_one({"_id": record_id}, {"$set": {
+        "status": "completed",
+        "status_code": status_code,
+        "body": orjson.dumps(content, default=_orjson_default).decode()
+    }})
+
+async def run_claimed(record_id: str, handler):
+    finished = _idempotency_inflight[record_id] = asyncio.Event()
+    try:
+        try:
+            result = await handler()
+        except HTTPException as e:
+            # Deterministic client errors are final answers for this request and get replayed like successes
+            if e.status_code < 500 and e.status_code not in IDEMPOTENCY_TRANSIENT_STATUS_CODES:
+                await complete_idempotency_key(record_id, e.status_code, {"detail": e.detail})
+            else:
+                await db.idempotency_keys.delete_one({"_id": record_id})
+            raise
+        except BaseException:
+            await db.idempotency_keys.delete_one({"_id": record_id})
+            raise
+        await complete_idempotency_key(record_id, 200, result)
+        return result
+    finally:
+        finished.set()
+        if _idempotency_inflight.get(record_id) is finished:
+            del _idempotency_inflight[record_id]
+
+def replay_response(record: Dict[str, Any]) -> Response:
+    return Response(
+        content=record["body"],
+        status_code=record["status_code"],
+        media_type="application/json",
+        headers={"Idempotent-Replayed": "true"}
+    )
+
+async def idempotent(scope: str, user_id: str, key: Optional[str], payload: Any, handler):
+    if key is None:
+        return await handler()
+    if not key or len(key) > MAX_IDEMPOTENCY_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key must be 1-{MAX_IDEMPOTENCY_KEY_LENGTH} characters")
+    
+    record_id = f"{scope}:{user_id}:{key}"
+    fingerprint = request_fingerprint(payload)
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    delay = 0.05
+    while True:
+        if await claim_idempotency_key(record_id, fingerprint):
+            return await run_claimed(record_id, handler)
+        
+        record = await db.idempotency_keys.find_one({"_id": record_id})
+        if record is None:
+            continue  # released by a failed attempt; claim it again
+        if record["fingerprint"] != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+        if record["status"] == "completed":
+            return replay_response(record)
+        if record["locked_until"] <= datetime.utcnow() and await take_over_idempotency_key(record_id, record["locked_until"]):
+            return await run_claimed(record_id, handler)
+        if time.monotonic() >= deadline:
+            raise HTTPException(
+                status_code=409,
+                detail="A request with this Idempotency-Key is still in progress",
+                headers={"Retry-After": "1"}
+            )
+        
+        # Same-worker duplicates are woken as soon as the first request finishes; others poll
+        inflight = _idempotency_inflight.get(record_id)
+        if inflight is None:
+            await asyncio.sleep(delay)
+        else:
+            try:
+                await asyncio.wait_for(inflight.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+        delay = min(delay * 2, 0.5)
+
 # === CART ROUTES ===
 @api_router.get("/cart", response_model=Cart)
-async def get_cart(current_user: User = Depends(get_current_user)):
-    cart_doc = await db.carts.find_one({"user_id": current_user.id})
+async def get_cart(response: Response, current_user: TokenClaims = Depends(get_current_claims)):
+    cart_doc = await db.carts.find_one({"user_id": current_user.id}, {"_id": 0})
     if not cart_doc:
-        # Create empty cart
-        cart = Cart(user_id=current_user.id)
-        await db.carts.insert_one(cart.dict())
-        return cart
-    return Cart(**cart_doc)
+        # Create empty cart; an upsert, so concurrent first loads don't race on the user_id index
+        cart_doc = await apply_cart_update(current_user.id, [])
+    return model_response(Cart(**cart_doc), response)
 
 @api_router.post("/cart/add")
-async def add_to_cart(item: AddToCart, current_user: User = Depends(get_current_user)):
-    # Get product
-    product_doc = await db.products.find_one({"id": item.product_id})
+async def add_to_cart(
+    item: AddToCart,
+    idempotency_key: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user)
+):
+    # Add is not repeatable (it increments the quantity), so retries can send an Idempotency-Key
+    async def add():
+        # Get product
+        product_doc = await get_product_doc(item.product_id)
+        if not product_doc:
+            raise HTTPException(status_code=404, detail="Product not found")
+        
+        cart_doc = await apply_cart_update(
+            current_user.id,
+            [cart_add_stage(item.product_id, item.quantity, product_doc["price"])]
+        )
+        return {"message": "Item added to cart", "cart": Cart(**cart_doc)}
+    
+    return await idempotent("cart/add", current_user.id, idempotency_key, item.dict(), add)
+
+@api_router.put("/cart/items/{product_id}")
+async def set_cart_quantity(product_id: str, item: SetCartQuantity, current_user: User = Depends(get_current_user)):
+    if item.quantity == 0:
+        cart_doc = await apply_cart_update(current_user.id, [cart_remove_stage(product_id)], upsert=False)
+        if cart_doc is None:
+            raise HTTPException(status_code=404, detail="Cart not found")
+        return {"message": "Item removed from cart", "cart": Cart(**cart_doc)}
+    
+    product_doc = await get_product_doc(product_id)
     if not product_doc:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    product = Product(**product_doc)
+    cart_doc = await apply_cart_update(
+        current_user.id,
+        [cart_set_stage(product_id, item.quantity, product_doc["price"])]
+    )
+    return {"message": "Cart updated", "cart": Cart(**cart_doc)}
+
+# Applies every operation, in order, in one atomic update
+@api_router.patch("/cart")
+async def update_cart_batch(batch: CartBatch, current_user: User = Depends(get_current_user)):
+    product_ids = {operation.product_id for operation in batch.operations if operation.op != "remove"}
+    prices: Dict[str, float] = {}
+    if product_ids:
+        products = await get_product_docs(list(product_ids))
+        prices = {product_id: product["price"] for product_id, product in products.items()}
+        missing = sorted(product_ids - set(prices))
+        if missing:
+            raise HTTPException(status_code=404, detail=f"Products not found: {', '.join(missing)}")
     
-    # Get or create cart
-    cart_doc = await db.carts.find_one({"user_id": current_user.id})
-    if not cart_doc:
-        cart = Cart(user_id=current_user.id)
-    else:
-        cart = Cart(**cart_doc)
+    stages = []
+    for operation in batch.operations:
+        if operation.op == "remove" or (operation.op == "set" and operation.quantity == 0):
+            stages.append(cart_remove_stage(operation.product_id))
+        elif operation.op == "set":
+            stages.append(cart_set_stage(operation.product_id, operation.quantity, prices[operation.product_id]))
+        else:
+            stages.append(cart_add_stage(operation.product_id, operation.quantity, prices[operation.product_id]))
     
-    # Add or update item in cart
-    existing_item = None
-    for cart_item in cart.items:
-        if cart_item.product_id == item.product_id:
-            existing_item = cart_item
-            break
+    cart_doc = await apply_cart_update(current_user.id, stages)
+    return {"message": "Cart updated", "cart": Cart(**cart_doc)}
+
+@api_router.delete("/cart/remove/{product_id}")
+async def remove_from_cart(product_id: str, current_user: User = Depends(get_current_user)):
+    cart_doc = await apply_cart_update(current_user.id, [cart_remove_stage(product_id)], upsert=False)
+    if cart_doc is None:
+        raise HTTPException(status_code=404, detail="Cart not found")
+    return {"message": "Item removed from cart", "cart": Cart(**cart_doc)}
+
+# === INVENTORY ===
+# Stock is only ever taken with a conditional decrement ({stock: {$gte: qty}}), so concurrent
+# checkouts can't drive it below zero. An order's lines are taken concurrently and any that
+# succeeded are put back if another line is short. (An unordered bulk_write would be one round
+# trip, but it only reports how many conditional updates matched, not which.)
+class InsufficientStockError(Exception):
+    def __init__(self, product_id: str):
+        super().__init__(product_id)
+        self.product_id = product_id
+
+# A non-positive quantity would pass the $gte filter and add stock instead of taking it
+class InvalidStockQuantityError(ValueError):
+    def __init__(self, product_id: str):
+        super().__init__(product_id)
+        self.product_id = product_id
+
+def stock_lines(items) -> Dict[str, int]:
+    lines: Dict[str, int] = {}
+    for item in items:
+        item = item if isinstance(item, dict) else item.dict()
+        lines[item["product_id"]] = lines.get(item["product_id"], 0) + item["quantity"]
+    return lines
+
+# Hot SKUs can spread their stock over N documents in stock_shards ({_id: "<product id>:<n>"}).
+# Buyers start at a random shard, so concurrent decrements land on different documents instead
+# of queueing on one. While sharded, the product's own stock field still counts: it collects units
+# that come back while a shard is drained and anything written there directly (e.g. a bulk import),
+# and is the last place a sale takes from. Displayed stock is that plus the sum of the shards.
+def stock_shard_id(product_id: str, shard: int) -> str:
+    return f"{product_id}:{shard}"
+
+async def product_stock_shards(product_id: str, fresh: bool = False) -> int:
+    if fresh:
+        product = await db.products.find_one({"id": product_id}, {"_id": 0, "stock_shards": 1})
+    else:
+        product = await get_product_doc(product_id)
+    return (product or {}).get("stock_shards") or 0
+
+# Product docs and listing pages are cached without trusting their stock (with_live_stock overlays
+# it), so a stock write only drops this worker's short-lived stock entry; other workers catch up
+# within STOCK_CACHE_TTL_SECONDS. Nothing is published, so a sale costs no cross-worker traffic.
+def stock_changed(product_id: str):
+    stock_cache.invalidate(product_id)
+
+async def take_product_stock(product_id: str, quantity: int) -> bool:
+    result = await db.products.update_one({"id": product_id, "stock": {"$gte": quantity}}, {"$inc": {"stock": -quantity}})
+    return result.modified_count == 1
+
+async def take_shard_stock(shard_id: str, quantity: int) -> bool:
+    result = await db.stock_shards.update_one({"_id": shard_id, "stock": {"$gte": quantity}}, {"$inc": {"stock": -quantity}})
+    return result.modified_count == 1
+
+async def take_sharded_stock(product_id: str, shards: int, quantity: int) -> bool:
+    shard_ids = [stock_shard_id(product_id, shard) for shard in random.sample(range(shards), shards)]
+    for shard_id in shard_ids:
+        if await take_shard_stock(shard_id, quantity):
+            return True
+    if await take_product_stock(product_id, quantity):
+        return True
     
-    if existing_item:
-        existing_item.quantity += item.quantity
+    # No single source holds enough: gather the quantity across the shards and the product
+    # document (shard_id None), or give it all back
+    taken = []
+    remaining = quantity
+    for shard_id in [*shard_ids, None]:
+        if shard_id is None:
+            doc = await db.products.find_one({"id": product_id}, {"_id": 0, "stock": 1})
+        else:
+            doc = await db.stock_shards.find_one({"_id": shard_id}, {"stock": 1})
+        portion = min(doc.get("stock", 0), remaining) if doc else 0
+        if portion <= 0:
+            continue
+        if await (take_product_stock(product_id, portion) if shard_id is None else take_shard_stock(shard_id, portion)):
+            taken.append((shard_id, portion))
+            remaining -= portion
+            if remaining == 0:
+                return True
+    for shard_id, portion in taken:
+        if shard_id is None:
+            await db.products.update_one({"id": product_id}, {"$inc": {"stock": portion}})
+        else:
+            await return_shard_stock(product_id, shard_id, portion)
+    if taken:
+        stock_changed(product_id)
+    return False
+
+async def take_stock(product_id: str, quantity: int) -> bool:
+    shards = await product_stock_shards(product_id)
+    taken = await (take_sharded_stock(product_id, shards, quantity) if shards else take_product_stock(product_id, quantity))
+    if not taken:
+        # The cached mode may predate an admin switch; retry once against the stored one
+        current = await product_stock_shards(product_id, fresh=True)
+        if current == shards:
+            return False
+        taken = await (take_sharded_stock(product_id, current, quantity) if current else take_product_stock(product_id, quantity))
+    if taken:
+        stock_changed(product_id)
+    return taken
+
+async def return_shard_stock(product_id: str, shard_id: str, quantity: int):
+    result = await db.stock_shards.update_one({"_id": shard_id}, {"$inc": {"stock": quantity}})
+    if not result.matched_count:
+        # Drained by a reshard: the product document always counts
+        await db.products.update_one({"id": product_id}, {"$inc": {"stock": quantity}})
+
+async def return_stock(product_id: str, quantity: int):
+    shards = await product_stock_shards(product_id)
+    if shards:
+        await return_shard_stock(product_id, stock_shard_id(product_id, random.randrange(shards)), quantity)
     else:
-        cart_item = CartItem(
-            product_id=item.product_id,
-            quantity=item.quantity,
-            price=product.price
+        await db.products.update_one({"id": product_id}, {"$inc": {"stock": quantity}})
+    stock_changed(product_id)
+
+async def distribute_stock(product_id: str, shards: int, stock: int):
+    share, extra = divmod(stock, shards)
+    await db.stock_shards.bulk_write([
+        ReplaceOne(
+            {"_id": stock_shard_id(product_id, shard)},
+            {"product_id": product_id, "stock": share + (1 if shard < extra else 0)},
+            upsert=True
         )
-        cart.items.append(cart_item)
-    
-    # Calculate total
-    cart.total = sum(item.quantity * item.price for item in cart.items)
-    cart.updated_at = datetime.utcnow()
-    
-    # Update in database
-    await db.carts.replace_one(
-        {"user_id": current_user.id},
-        cart.dict(),
-        upsert=True
+        for shard in range(shards)
+    ], ordered=False)
+    stock_cache.invalidate(product_id)
+
+# Switches a product between a single counter (shards=0) and N sub-counters. Everything is first
+# drained back into the product document and then spread over the new shards; checkouts racing
+# the switch can fail with 409 for that moment but never oversell.
+async def set_stock_shards(product_id: str, shards: int) -> Optional[Dict[str, Any]]:
+    previous = await db.products.find_one_and_update(
+        {"id": product_id},
+        {"$set": {"stock_shards": shards}},
+        projection={"_id": 0, "stock_shards": 1},
+        return_document=ReturnDocument.BEFORE
     )
+    if previous is None:
+        return None
     
-    return {"message": "Item added to cart", "cart": cart}
+    drained = 0
+    for shard in range(previous.get("stock_shards") or 0):
+        doc = await db.stock_shards.find_one_and_delete({"_id": stock_shard_id(product_id, shard)})
+        drained += doc["stock"] if doc else 0
+    
+    if shards:
+        product = await db.products.find_one_and_update(
+            {"id": product_id},
+            {"$set": {"stock": 0}},
+            projection={"_id": 0, "stock": 1},
+            return_document=ReturnDocument.BEFORE
+        )
+        stock = product.get("stock", 0) + drained
+        await distribute_stock(product_id, shards, stock)
+    else:
+        product = await db.products.find_one_and_update(
+            {"id": product_id},
+            {"$inc": {"stock": drained}},
+            projection={"_id": 0, "stock": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        stock = product.get("stock", 0)
+    stock_cache.invalidate(product_id)
+    await invalidate_product(product_id)
+    return {"product_id": product_id, "stock_shards": shards, "stock": stock}
 
-@api_router.delete("/cart/remove/{product_id}")
-async def remove_from_cart(product_id: str, current_user: User = Depends(get_current_user)):
-    cart_doc = await db.carts.find_one({"user_id": current_user.id})
-    if not cart_doc:
-        raise HTTPException(status_code=404, detail="Cart not found")
+stock_cache = TTLCache(STOCK_CACHE_TTL_SECONDS, PRODUCT_CACHE_MAX_SIZE)
+
+# Current stock per product: the product counter plus the sum of its shards, if any
+async def live_stock(product_ids: List[str]) -> Dict[str, int]:
+    totals = {product_id: stock_cache.get(product_id) for product_id in product_ids}
+    missing = [product_id for product_id, total in totals.items() if total is None]
+    if not missing:
+        return totals
     
-    cart = Cart(**cart_doc)
-    cart.items = [item for item in cart.items if item.product_id != product_id]
-    cart.total = sum(item.quantity * item.price for item in cart.items)
-    cart.updated_at = datetime.utcnow()
+    sharded = []
+    async for product in db.products.find({"id": {"$in": missing}}, {"_id": 0, "id": 1, "stock": 1, "stock_shards": 1}):
+        totals[product["id"]] = product.get("stock", 0)
+        if product.get("stock_shards"):
+            sharded.append(product["id"])
+    if sharded:
+        pipeline = [
+            {"$match": {"product_id": {"$in": sharded}}},
+            {"$group": {"_id": "$product_id", "stock": {"$sum": "$stock"}}}
+        ]
+        async for row in db.stock_shards.aggregate(pipeline):
+            totals[row["_id"]] += row["stock"]
+    for product_id in missing:
+        stock_cache.set(product_id, totals[product_id])
+    return totals
+
+# Products without a stock field (a sparse fieldset left it out) are passed through as they are
+async def with_live_stock(products: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    product_ids = [product["id"] for product in products if "stock" in product]
+    if not product_ids:
+        return products
+    totals = await live_stock(product_ids)
+    # Copies, so documents shared with product_cache are left untouched
+    return [
+        {**product, "stock": totals[product["id"]]} if totals.get(product["id"]) is not None else product
+        for product in products
+    ]
+
+async def release_stock(items):
+    await asyncio.gather(*[return_stock(product_id, quantity) for product_id, quantity in stock_lines(items).items()])
+
+# Lines taken for an order are recorded on it in reserved_items as they go, so the sweeper can give
+# them back if the process dies before the reservation is confirmed. Recording after the take (and
+# forgetting before the return) means a crash in between can only leak units, never add any.
+async def take_order_line(order_id: Optional[str], product_id: str, quantity: int) -> bool:
+    if not await take_stock(product_id, quantity):
+        return False
+    if order_id is not None:
+        await db.orders.update_one(
+            {"id": order_id},
+            {"$push": {"reserved_items": {"product_id": product_id, "quantity": quantity}}}
+        )
+    return True
+
+async def return_order_line(order_id: Optional[str], product_id: str, quantity: int):
+    if order_id is not None:
+        await db.orders.update_one({"id": order_id}, {"$pull": {"reserved_items": {"product_id": product_id}}})
+    await return_stock(product_id, quantity)
+
+async def reserve_stock(items, order_id: Optional[str] = None):
+    lines = stock_lines(items)
+    for product_id, quantity in lines.items():
+        if quantity <= 0:
+            raise InvalidStockQuantityError(product_id)
+    taken = await asyncio.gather(*[take_order_line(order_id, product_id, quantity) for product_id, quantity in lines.items()])
+    if all(taken):
+        return
     
-    await db.carts.replace_one({"user_id": current_user.id}, cart.dict())
-    return {"message": "Item removed from cart", "cart": cart}
+    await asyncio.gather(*[
+        return_order_line(order_id, product_id, quantity)
+        for (product_id, quantity), ok in zip(lines.items(), taken) if ok
+    ])
+    raise InsufficientStockError(next(product_id for product_id, ok in zip(lines, taken) if not ok))
+
+# Cancels the matching order and puts its stock back. The status flip happens first and is atomic,
+# so each reservation is released exactly once. Orders from before reserved_items was recorded
+# release their items.
+async def cancel_reservation(query: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    order = await db.orders.find_one_and_update(
+        query,
+        {"$set": {"stock_status": "released", "order_status": "cancelled"}},
+        projection={"_id": 0, "id": 1, "items": 1, "reserved_items": 1}
+    )
+    if order is not None:
+        await release_stock(order.get("reserved_items", order["items"]))
+    return order
+
+# Orders still unpaid when their reservation expires are cancelled and their stock put back. That
+# includes orders stuck in "reserving", whose checkout died between taking stock and confirming it.
+async def release_expired_reservations() -> int:
+    released = 0
+    while True:
+        order = await cancel_reservation({
+            "stock_status": {"$in": ["reserving", "reserved"]},
+            "reservation_expires_at": {"$lte": datetime.utcnow()},
+            "payment_status": {"$ne": "paid"}
+        })
+        if order is None:
+            return released
+        released += 1
+
+async def release_expired_reservations_periodically():
+    while True:
+        await asyncio.sleep(RESERVATION_SWEEP_INTERVAL_SECONDS)
+        try:
+            released = await release_expired_reservations()
+            if released:
+                logger.info(f"Released stock for {released} expired reservations")
+        except Exception as e:
+            logger.error(f"Reservation sweep failed: {e}")
 
 # === ORDER ROUTES ===
 @api_router.post("/orders/create")
-async def create_order(order_data: CreateOrder, current_user: User = Depends(get_current_user)):
+async def create_order(
+    order_data: CreateOrder,
+    idempotency_key: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user)
+):
+    # A retried checkout with the same Idempotency-Key gets the original order back instead of a second one
+    return await idempotent(
+        "orders/create", current_user.id, idempotency_key, order_data.dict(),
+        lambda: place_order(order_data, current_user)
+    )
+
+async def place_order(order_data: CreateOrder, current_user: User) -> Dict[str, Any]:
     # Get user's cart
-    cart_doc = await db.carts.find_one({"user_id": current_user.id})
+    cart_doc = await db.carts.find_one({"user_id": current_user.id}, {"_id": 0, "items": 1, "total": 1})
     if not cart_doc or not cart_doc.get("items"):
         raise HTTPException(status_code=400, detail="Cart is empty")
     
-    cart = Cart(**cart_doc)
-    
-    # Create Razorpay order
-    razorpay_order = razorpay_client.order.create({
-        "amount": int(cart.total * 100),  # Convert to paise
-        "currency": "INR",
-        "payment_capture": 1
-    })
+    cart = Cart(user_id=current_user.id, **cart_doc)
     
-    # Create order in database
+    # The order exists before any stock is taken, so a checkout that dies half way leaves a
+    # "reserving" order behind for the sweeper instead of stock nobody will give back
     order = Order(
         user_id=current_user.id,
         items=cart.items,
         total=cart.total,
-        razorpay_order_id=razorpay_order["id"],
-        shipping_address=order_data.shipping_address
+        shipping_address=order_data.shipping_address,
+        stock_status="reserving",
+        reservation_expires_at=datetime.utcnow() + timedelta(seconds=STOCK_RESERVATION_TTL_SECONDS)
     )
+    await db.orders.insert_one({**order.dict(), "reserved_items": []})
+    
+    try:
+        await reserve_stock(cart.items, order.id)
+    except InsufficientStockError as e:
+        # reserve_stock already gave back what it took, so the order is just dropped
+        await db.orders.delete_one({"id": order.id, "stock_status": "reserving"})
+        raise HTTPException(status_code=409, detail=f"Insufficient stock for product {e.product_id}")
+    except InvalidStockQuantityError as e:
+        await db.orders.delete_one({"id": order.id, "stock_status": "reserving"})
+        raise HTTPException(status_code=400, detail=f"Invalid quantity for product {e.product_id}")
+    except BaseException:
+        await cancel_reservation({"id": order.id, "stock_status": "reserving"})
+        raise
     
-    await db.orders.insert_one(order.dict())
+    confirmed = await db.orders.update_one({"id": order.id, "stock_status": "reserving"}, {"$set": {"stock_status": "reserved"}})
+    if not confirmed.matched_count:
+        # The sweeper already gave this reservation back
+        raise HTTPException(status_code=409, detail="Stock reservation expired, please retry")
+    
+    # Create Razorpay order; on any failure up to here the stock is given back
+    try:
+        razorpay_order = await payment_gateway.create_order(
+            amount=int(cart.total * 100),  # Convert to paise
+            currency="INR",
+            receipt=order.id
+        )
+        await db.orders.update_one({"id": order.id}, {"$set": {"razorpay_order_id": razorpay_order["id"]}})
+    except BaseException as e:
+        await cancel_reservation({"id": order.id, "stock_status": "reserved"})
+        if isinstance(e, PaymentGatewayUnavailable):
+            raise HTTPException(status_code=503, detail="Payment gateway unavailable, please retry")
+        if isinstance(e, PaymentGatewayError):
+            raise HTTPException(status_code=502, detail="Payment gateway error")
+        raise
+    await bump_dashboard_stats(total_orders=1)
     
     # Clear cart
     await db.carts.update_one(
@@ -377,6 +2503,22 @@ async def create_order(order_data: CreateOrder, current_user: User = Depends(get
         "key": RAZORPAY_KEY_ID
     }
 
+# Once an order is paid the sweeper no longer touches it, so a reservation seen as "reserved" here
+# is ours to commit. A payment that lands after the reservation expired tries to take the stock
+# again; if it is gone the order is flagged for a refund.
+async def commit_reservation(order_doc: Dict[str, Any]):
+    stock_status = order_doc.get("stock_status")
+    if stock_status == "released":
+        try:
+            await reserve_stock(order_doc["items"])
+        except InsufficientStockError:
+            logger.warning(f"Order {order_doc['id']} was paid after its reservation expired and stock ran out")
+            await db.orders.update_one({"id": order_doc["id"]}, {"$set": {"order_status": "refund_pending"}})
+            return
+    elif stock_status != "reserved":
+        return
+    await db.orders.update_one({"id": order_doc["id"]}, {"$set": {"stock_status": "committed"}})
+
 @api_router.post("/orders/verify-payment")
 async def verify_payment(request: Request, current_user: User = Depends(get_current_user)):
     body = await request.json()
@@ -386,65 +2528,261 @@ async def verify_payment(request: Request, current_user: User = Depends(get_curr
     razorpay_payment_id = body.get("razorpay_payment_id")
     razorpay_signature = body.get("razorpay_signature")
     
-    try:
-        razorpay_client.utility.verify_payment_signature({
-            'razorpay_order_id': razorpay_order_id,
-            'razorpay_payment_id': razorpay_payment_id,
-            'razorpay_signature': razorpay_signature
-        })
-        
-        # Update order status
-        await db.orders.update_one(
-            {"razorpay_order_id": razorpay_order_id, "user_id": current_user.id},
-            {"$set": {
-                "payment_status": "paid",
-                "razorpay_payment_id": razorpay_payment_id,
-                "order_status": "processing"
-            }}
-        )
-        
-        return {"status": "success", "message": "Payment verified successfully"}
-        
-    except Exception as e:
+    # Signature is an HMAC over order|payment id, so it is checked locally without calling the gateway
+    if not payment_gateway.verify_payment_signature(razorpay_order_id, razorpay_payment_id, razorpay_signature):
         return {"status": "failure", "message": "Payment verification failed"}
+    
+    # Update order status; only the first transition to paid counts towards revenue
+    order_doc = await db.orders.find_one_and_update(
+        {
+            "razorpay_order_id": razorpay_order_id,
+            "user_id": current_user.id,
+            "payment_status": {"$ne": "paid"}
+        },
+        {"$set": {
+            "payment_status": "paid",
+            "razorpay_payment_id": razorpay_payment_id,
+            "order_status": "processing"
+        }},
+        projection={"_id": 0, "id": 1, "total": 1, "items": 1, "stock_status": 1}
+    )
+    if order_doc is not None:
+        await bump_dashboard_stats(total_revenue=order_doc.get("total", 0))
+        await commit_reservation(order_doc)
+    
+    return {"status": "success", "message": "Payment verified successfully"}
 
 @api_router.get("/orders", response_model=List[Order])
-async def get_user_orders(current_user: User = Depends(get_current_user)):
-    orders = await db.orders.find({"user_id": current_user.id}).sort("created_at", -1).to_list(100)
-    return [Order(**order) for order in orders]
+async def get_user_orders(response: Response, fields: Optional[str] = None, current_user: TokenClaims = Depends(get_current_claims)):
+    selected_fields = parse_fields(fields, Order, ORDER_FIELD_PRESETS)
+    orders = await db.orders.find(
+        {"user_id": current_user.id},
+        fields_projection(selected_fields)
+    ).sort("created_at", -1).to_list(100)
+    adapter = sparse_list_adapter if selected_fields else order_list_adapter
+    return json_list_response(adapter, orders, response)
 
 @api_router.get("/admin/orders", response_model=List[Order])
-async def get_all_orders(admin_user: User = Depends(get_admin_user)):
-    orders = await db.orders.find().sort("created_at", -1).to_list(100)
-    return [Order(**order) for order in orders]
+async def get_all_orders(response: Response, fields: Optional[str] = None, admin_user: TokenClaims = Depends(get_admin_user)):
+    selected_fields = parse_fields(fields, Order, ORDER_FIELD_PRESETS)
+    orders = await db.orders.find({}, fields_projection(selected_fields)).sort("created_at", -1).to_list(100)
+    adapter = sparse_list_adapter if selected_fields else order_list_adapter
+    return json_list_response(adapter, orders, response)
+
+# === EXPORTS ===
+# Full-table dumps for admins, streamed batch by batch so memory stays flat however large the collection
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+export_adapter = TypeAdapter(Any)
+
+def export_date_filter(created_from: Optional[datetime], created_to: Optional[datetime]) -> Dict[str, Any]:
+    # Stored timestamps are naive UTC
+    bounds = {}
+    for op, value in (("$gte", created_from), ("$lt", created_to)):
+        if value is not None:
+            if value.tzinfo is not None:
+                value = value.astimezone(timezone.utc).replace(tzinfo=None)
+            bounds[op] = value
+    if "$gte" in bounds and "$lt" in bounds and bounds["$gte"] >= bounds["$lt"]:
+        raise HTTPException(status_code=400, detail="created_from must be before created_to")
+    return {"created_at": bounds} if bounds else {}
+
+def csv_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (list, dict)):
+        return export_adapter.dump_json(value).decode()
+    return value
+
+# prepare, if given, is awaited on each batch of documents before it is written out
+async def export_rows(cursor, format: str, columns: List[str], prepare=None):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if format == "csv":
+        writer.writerow(columns)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    
+    batch = []
+    async for doc in cursor:
+        batch.append(doc)
+        if len(batch) < EXPORT_BATCH_SIZE:
+            continue
+        yield await export_batch(batch, buffer, writer, format, columns, prepare)
+        batch = []
+    
+    if batch:
+        yield await export_batch(batch, buffer, writer, format, columns, prepare)
+
+async def export_batch(batch: List[Dict[str, Any]], buffer: io.StringIO, writer, format: str, columns: List[str], prepare) -> str:
+    if prepare is not None:
+        batch = await prepare(batch)
+    for doc in batch:
+        if format == "csv":
+            writer.writerow([csv_value(doc.get(column)) for column in columns])
+        else:
+            buffer.write(export_adapter.dump_json(select_fields(doc, columns)).decode())
+            buffer.write("\n")
+    chunk = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return chunk
+
+def export_response(name: str, cursor, format: str, columns: List[str], prepare=None) -> StreamingResponse:
+    filename = f"{name}-{datetime.utcnow():%Y%m%d%H%M%S}.{format}"
+    return StreamingResponse(
+        export_rows(cursor, format, columns, prepare),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@api_router.get("/admin/export/orders")
+async def export_orders(
+    format: Literal["ndjson", "csv"] = "ndjson",
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    payment_status: Optional[str] = None,
+    order_status: Optional[str] = None,
+    fields: Optional[str] = None,
+    admin_user: TokenClaims = Depends(get_admin_user)
+):
+    # Each filter combination is served by created_at or one of the <status>_created_at indexes
+    columns = parse_fields(fields, Order, ORDER_FIELD_PRESETS) or list(Order.model_fields)
+    query = export_date_filter(created_from, created_to)
+    if payment_status:
+        query["payment_status"] = payment_status
+    if order_status:
+        query["order_status"] = order_status
+    
+    cursor = db.orders.find(query, fields_projection(columns)).sort("created_at", DESCENDING).batch_size(EXPORT_BATCH_SIZE)
+    return export_response("orders", cursor, format, columns)
+
+@api_router.get("/admin/export/products")
+async def export_products(
+    format: Literal["ndjson", "csv"] = "ndjson",
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    category: Optional[str] = None,
+    fields: Optional[str] = None,
+    admin_user: TokenClaims = Depends(get_admin_user)
+):
+    # Same sort as the catalog listing, so created_at_id / category_created_at_id cover it
+    columns = parse_fields(fields, Product, PRODUCT_FIELD_PRESETS) or list(Product.model_fields)
+    query = export_date_filter(created_from, created_to)
+    if category:
+        query["category"] = category
+    
+    # products.stock alone misses sharded stock and sales since the last write, so each batch gets the
+    # live figures (the id is fetched for that and dropped again on output)
+    prepare = with_live_stock if "stock" in columns else None
+    cursor = db.products.find(query, fields_projection(columns, "id")).sort(PRODUCT_SORT).batch_size(EXPORT_BATCH_SIZE)
+    return export_response("products", cursor, format, columns, prepare)
 
 # === ADMIN ROUTES ===
 @api_router.get("/admin/stats")
-async def get_admin_stats(admin_user: User = Depends(get_admin_user)):
-    total_products = await db.products.count_documents({})
-    total_orders = await db.orders.count_documents({})
-    total_users = await db.users.count_documents({"role": "customer"})
-    
-    # Calculate total revenue
-    orders = await db.orders.find({"payment_status": "paid"}).to_list(1000)
-    total_revenue = sum(order.get("total", 0) for order in orders)
+async def get_admin_stats(admin_user: TokenClaims = Depends(get_admin_user)):
+    stats = await db.stats.find_one({"_id": DASHBOARD_STATS_ID}, {"_id": 0})
+    if stats is None:
+        stats = await rebuild_dashboard_stats()
     
     return {
-        "total_products": total_products,
-        "total_orders": total_orders,
-        "total_users": total_users,
-        "total_revenue": total_revenue
+        "total_products": stats.get("total_products", 0),
+        "total_orders": stats.get("total_orders", 0),
+        "total_users": stats.get("total_users", 0),
+        "total_revenue": stats.get("total_revenue", 0)
+    }
+
+# Recounts from the source collections, to correct drift after manual data fixes
+@api_router.post("/admin/stats/rebuild")
+async def rebuild_admin_stats(admin_user: TokenClaims = Depends(get_admin_user)):
+    return await rebuild_dashboard_stats()
+
+@api_router.get("/admin/metrics")
+async def get_admin_metrics(admin_user: TokenClaims = Depends(get_admin_user)):
+    return {
+        "password_hashing": password_hasher.metrics(),
+        "user_cache": user_cache.stats(),
+        "token_version_cache": token_version_cache.stats(),
+        "product_cache": product_cache.stats(),
+        "product_query_cache": product_query_cache.stats(),
+        "catalog_payload_cache": catalog_payload_cache.stats(),
+        "category_cache": category_cache.stats(),
+        "search_index": search_index.stats(),
+        "payment_gateway": payment_gateway.stats(),
+        "startup": startup_timings,
+        "mongo_pool": mongo_pool_metrics.stats()
     }
 
+@api_router.get("/admin/indexes")
+async def get_index_report(admin_user: TokenClaims = Depends(get_admin_user)):
+    return await index_report(db)
+
+@api_router.put("/admin/products/{product_id}/stock-shards")
+async def update_stock_shards(product_id: str, update: StockShardsUpdate, admin_user: TokenClaims = Depends(get_admin_user)):
+    result = await set_stock_shards(product_id, update.shards)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Product not found")
+    return result
+
+@api_router.post("/admin/inventory/release-expired")
+async def release_expired_stock(admin_user: TokenClaims = Depends(get_admin_user)):
+    return {"released": await release_expired_reservations()}
+
+@api_router.post("/admin/categories/reconcile")
+async def reconcile_categories(admin_user: TokenClaims = Depends(get_admin_user)):
+    counts = await reconcile_category_counts()
+    return [{"name": cat["_id"], "count": cat["count"]} for cat in counts]
+
+@api_router.post("/admin/users/{user_id}/revoke-tokens")
+async def revoke_tokens_for_user(user_id: str, admin_user: TokenClaims = Depends(get_admin_user)):
+    result = await revoke_user_tokens(user_id)
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="User not found")
+    return {"message": "User tokens revoked"}
+
 # === CATEGORIES ===
+# category_counts holds one {_id: category, count} document per category, bumped on every product write
+async def bump_category_count(category: Optional[str], delta: int):
+    await db.category_counts.update_one({"_id": category}, {"$inc": {"count": delta}}, upsert=True)
+    await category_cache.clear()
+
+# Recomputes the counts from products to correct any drift
+async def reconcile_category_counts() -> List[Dict[str, Any]]:
+    previous = {cat["_id"]: cat["count"] async for cat in db.category_counts.find({"count": {"$gt": 0}}, {"_id": 1, "count": 1})}
+    pipeline = [{"$group": {"_id": "$category", "count": {"$sum": 1}}}]
+    counts = await db.products.aggregate(pipeline).to_list(None)
+    if counts:
+        await db.category_counts.bulk_write(
+            [ReplaceOne({"_id": count["_id"]}, count, upsert=True) for count in counts],
+            ordered=False
+        )
+    await db.category_counts.delete_many({"_id": {"$nin": [count["_id"] for count in counts]}})
+    await category_cache.clear()
+    if previous != {count["_id"]: count["count"] for count in counts}:
+        await bump_catalog_version()
+    return counts
+
+async def reconcile_category_counts_periodically():
+    while True:
+        await asyncio.sleep(CATEGORY_RECONCILE_INTERVAL_SECONDS)
+        try:
+            await reconcile_category_counts()
+        except Exception as e:
+            logger.error(f"Category count reconciliation failed: {e}")
+
 @api_router.get("/categories")
-async def get_categories():
-    pipeline = [
-        {"$group": {"_id": "$category", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}}
-    ]
-    categories = await db.products.aggregate(pipeline).to_list(100)
-    return [{"name": cat["_id"], "count": cat["count"]} for cat in categories]
+async def get_categories(request: Request, response: Response):
+    catalog = await get_catalog_version()
+    not_modified = conditional_response(request, response, f'W/"k{catalog["version"]}"', catalog.get("updated_at"))
+    if not_modified is not None:
+        return not_modified
+    
+    categories = await category_cache.get("all")
+    if categories is None:
+        counts = await catalog_db.category_counts.find({"count": {"$gt": 0}}, {"_id": 1, "count": 1}).sort([("count", -1), ("_id", 1)]).to_list(100)
+        categories = [{"name": cat["_id"], "count": cat["count"]} for cat in counts]
+        await category_cache.set("all", categories)
+    return categories
 
 
 # Logging
@@ -472,92 +2810,228 @@ logger = logging.getLogger(__name__)
 #         )
 #         await db.users.insert_one(admin_user.dict())
 #         logger.info("Admin user created: admin@francium.com / admin123")
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    # Startup code
+# === MONGO CLIENT ===
+# Pool events fire on the driver's worker threads; check-out start and finish happen on the same
+# thread, so a thread-local start time gives the wait for a free connection
+class MongoPoolMetrics(monitoring.ConnectionPoolListener):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.checkout_timeouts = 0
+        self.checked_out = 0
+        self.connections = 0
+        self.connections_created = 0
+        self.pool_clears = 0
+        self.wait_ms_total = 0.0
+        self.wait_ms_max = 0.0
+
+    def _waited_ms(self) -> float:
+        started = getattr(self._local, "started", None)
+        self._local.started = None
+        return (time.perf_counter() - started) * 1000 if started is not None else 0.0
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        waited = self._waited_ms()
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.wait_ms_total += waited
+            self.wait_ms_max = max(self.wait_ms_max, waited)
+
+    def connection_check_out_failed(self, event):
+        self._waited_ms()
+        with self._lock:
+            self.checkout_failures += 1
+            if event.reason == monitoring.ConnectionCheckOutFailedReason.TIMEOUT:
+                self.checkout_timeouts += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.connections += 1
+            self.connections_created += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.connections -= 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
 
+    def pool_cleared(self, event):
+        with self._lock:
+            self.pool_clears += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "max_pool_size": MONGO_MAX_POOL_SIZE,
+                "min_pool_size": MONGO_MIN_POOL_SIZE,
+                "connections": self.connections,
+                "connections_created": self.connections_created,
+                "checked_out": self.checked_out,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "checkout_timeouts": self.checkout_timeouts,
+                "pool_clears": self.pool_clears,
+                "avg_wait_ms": round(self.wait_ms_total / self.checkouts, 3) if self.checkouts else 0.0,
+                "max_wait_ms": round(self.wait_ms_max, 3)
+            }
+
+mongo_pool_metrics = MongoPoolMetrics()
+
+READ_PREFERENCES = {
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+def read_preference(mode: str, max_staleness: int = -1):
+    if mode == "primary":
+        return Primary()
+    if mode not in READ_PREFERENCES:
+        raise ValueError(f"Unknown read preference: {mode}")
+    return READ_PREFERENCES[mode](max_staleness=max_staleness)
+
+def build_mongo_client() -> AsyncIOMotorClient:
+    options = {
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "readPreference": MONGO_READ_PREFERENCE,
+        "event_listeners": [mongo_pool_metrics],
+    }
+    if MONGO_MAX_IDLE_TIME_MS:
+        options["maxIdleTimeMS"] = MONGO_MAX_IDLE_TIME_MS
+    if MONGO_WAIT_QUEUE_TIMEOUT_MS:
+        options["waitQueueTimeoutMS"] = MONGO_WAIT_QUEUE_TIMEOUT_MS
+    if MONGO_COMPRESSORS:
+        options["compressors"] = MONGO_COMPRESSORS
+    return AsyncIOMotorClient(mongo_url, **options)
+
+# Built inside lifespan so the client binds to the server's event loop
+async def connect_mongo():
+    global client, db, catalog_db
+    client = build_mongo_client()
+    db = client[os.environ['DB_NAME']]
+    catalog_db = db.with_options(
+        read_preference=read_preference(MONGO_CATALOG_READ_PREFERENCE, MONGO_CATALOG_MAX_STALENESS_SECONDS)
+    )
+    # Concurrent pings each hold a connection, so the pool is open before the first request needs it
+    await asyncio.gather(*[client.admin.command("ping") for _ in range(max(1, MONGO_WARMUP_CONNECTIONS))])
+
+# === STARTUP ===
+# Startup runs as independent phases under asyncio.gather; each records its wall time in startup_timings
+startup_timings: Dict[str, float] = {}
+
+async def timed_phase(name: str, awaitable):
+    started = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        startup_timings[name] = round((time.perf_counter() - started) * 1000, 1)
+
+def load_seed_products() -> List[Dict[str, Any]]:
+    if not SEED_PRODUCTS_FILE:
+        return []
+    with open(SEED_PRODUCTS_FILE) as f:
+        return [Product(**item).dict() for item in json.load(f)]
+
+async def seed_admin_user():
     # Create admin user if not exists
-    admin_exists = await db.users.find_one({"email": "admin@francium.com"})
+    admin_exists = await db.users.find_one({"email": "admin@francium.com"}, {"_id": 1})
     if not admin_exists:
         admin_user = User(
             email="admin@francium.com",
-            password_hash=hash_password("admin123"),
+            password_hash=await password_hasher.hash("admin123"),
             full_name="Admin User",
             role="admin"
         )
         await db.users.insert_one(admin_user.dict())
         logger.info("Admin user created: admin@francium.com / admin123")
- 
+
+async def seed_sample_products() -> int:
     # Create sample products if none exist
-    product_count = await db.products.count_documents({})
-    if product_count == 0:
-        sample_products = [
-            Product(
-                name="Wireless Bluetooth Headphones",
-                description="Premium wireless headphones with noise cancellation and 24-hour battery life",
-                price=2999.00,
-                category="Electronics",
-                image_url="https://images.unsplash.com/photo-1573164574230-db1d5e960238?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NDk1ODF8MHwxfHNlYXJjaHwzfHxlY29tbWVyY2V8ZW58MHx8fGJsdWV8MTc1MzM1MjIxN3ww&ixlib=rb-4.1.0&q=85",
-                stock=50
-            ),
-            Product(
-                name="Smart Watch Pro",
-                description="Advanced fitness tracking smartwatch with heart rate monitor and GPS",
-                price=4999.00,
-                category="Electronics",
-                image_url="https://images.unsplash.com/photo-1615833843615-884a03a10642?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NDk1ODF8MHwxfHNlYXJjaHwyfHxlY29tbWVyY2V8ZW58MHx8fGJsdWV8MTc1MzM1MjIxN3ww&ixlib=rb-4.1.0&q=85",
-                stock=30
-            ),
-            Product(
-                name="Premium Blue Shirt",
-                description="High-quality cotton shirt perfect for formal and casual occasions",
-                price=1299.00,
-                category="Fashion",
-                image_url="https://images.unsplash.com/photo-1589810635657-232948472d98?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NTY2Njl8MHwxfHNlYXJjaHwyfHxzaG9wcGluZ3xlbnwwfHx8Ymx1ZXwxNzUzMzUyMjI1fDA&ixlib=rb-4.1.0&q=85",
-                stock=100
-            ),
-            Product(
-                name="Leather Laptop Bag",
-                description="Stylish and durable leather laptop bag for professionals",
-                price=3499.00,
-                category="Accessories",
-                image_url="https://images.unsplash.com/photo-1647221597996-54f3d0f73809?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NDk1ODF8MHwxfHNlYXJjaHwxfHxlY29tbWVyY2V8ZW58MHx8fGJsdWV8MTc1MzM1MjIxN3ww&ixlib=rb-4.1.0&q=85",
-                stock=25
-            ),
-            Product(
-                name="Designer Glasses",
-                description="Trendy designer glasses with UV protection and lightweight frame",
-                price=1899.00,
-                category="Accessories",
-                image_url="https://images.unsplash.com/photo-1615833843615-884a03a10642?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NDk1ODF8MHwxfHNlYXJjaHwyfHxlY29tbWVyY2V8ZW58MHx8fGJsdWV8MTc1MzM1MjIxN3ww&ixlib=rb-4.1.0&q=85",
-                stock=40
-            ),
-            Product(
-                name="Yoga Mat Premium",
-                description="High-density yoga mat with excellent grip and cushioning",
-                price=899.00,
-                category="Sports",
-                image_url="https://images.unsplash.com/photo-1530735038726-a73fd6e6a349?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NTY2Njl8MHwxfHNlYXJjaHwxfHxzaG9wcGluZ3xlbnwwfHx8Ymx1ZXwxNzUzMzUyMjI1fDA&ixlib=rb-4.1.0&q=85",
-                stock=60
-            )
-        ]
-        
-        for product in sample_products:
-            await db.products.insert_one(product.dict())
-        
+    if await db.products.find_one({}, {"_id": 1}) is not None:
+        return 0
+    sample_products = load_seed_products()
+    if sample_products:
+        await db.products.insert_many(sample_products, ordered=False)
+        await bump_dashboard_stats(total_products=len(sample_products))
         logger.info(f"Created {len(sample_products)} sample products")
+    return len(sample_products)
+
+async def prepare_catalog():
+    # Stats must exist before seeding bumps them, and the derived views need the seeded products
+    if await db.stats.find_one({"_id": DASHBOARD_STATS_ID}, {"_id": 1}) is None:
+        await timed_phase("dashboard_stats", rebuild_dashboard_stats())
+    seeded = await timed_phase("seed_products", seed_sample_products())
+    
+    derived = []
+    if seeded or await db.category_counts.estimated_document_count() == 0:
+        derived.append(timed_phase("category_counts", reconcile_category_counts()))
+    if SEARCH_MODE == "index":
+        catalog = await db.stats.find_one({"_id": CATALOG_VERSION_ID}, {"_id": 0, "version": 1}) or {}
+        search_index.catalog_version = catalog.get("version", 0)
+        derived.append(timed_phase("search_index", search_index.rebuild(db.products)))
+    await asyncio.gather(*derived)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Startup code
+    started = time.perf_counter()
+    await timed_phase("mongo_connect", connect_mongo())
+    await timed_phase("cache_backend", cache_backend.start(handle_remote_invalidation))
+    await asyncio.gather(
+        timed_phase("indexes", ensure_indexes(db)),
+        timed_phase("admin_user", seed_admin_user()),
+        timed_phase("catalog", prepare_catalog())
+    )
+    category_reconciler = asyncio.create_task(reconcile_category_counts_periodically())
+    reservation_sweeper = asyncio.create_task(release_expired_reservations_periodically())
+    startup_timings["total"] = round((time.perf_counter() - started) * 1000, 1)
+    
+    if SEARCH_MODE == "index":
+        logger.info(f"Search index built with {search_index.stats()['documents']} products")
+    logger.info("Startup completed in %.1f ms (%s)", startup_timings["total"], ", ".join(
+        f"{name}={elapsed:.1f}ms" for name, elapsed in startup_timings.items() if name != "total"
+    ))
     yield  # Application runs here
+    category_reconciler.cancel()
+    reservation_sweeper.cancel()
+    password_hasher.shutdown()
+    await payment_gateway.close()
+    await cache_backend.close()
     client.close()
-app = FastAPI(title="Francium E-commerce API", lifespan=lifespan)
+app = FastAPI(title="Francium E-commerce API", lifespan=lifespan, default_response_class=FastJSONResponse)
 
 # Include router
 app.include_router(api_router)
 
 # Middleware
+app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MIN_SIZE)
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Content-Disposition", "Idempotent-Replayed"],
 )
@@ -272,6 +272,115 @@ class FranciumAPITester:
             self.log_test("Get Cart", False, f"Get cart error: {str(e)}")
             return False
     
+    def test_set_cart_quantity(self):
+        """Test setting the quantity of a cart line"""
+        if not self.user_token:
+            self.log_test("Set Cart Quantity", False, "No user token available")
+            return False
+            
+        try:
+            products_response = self.session.get(f"{self.base_url}/products")
+            if products_response.status_code != 200 or not products_response.json():
+                self.log_test("Set Cart Quantity", False, "No products available to update in cart")
+                return False
+                
+            product = products_response.json()[0]
+            
+            headers = {"Authorization": f"Bearer {self.user_token}"}
+            response = self.session.put(f"{self.base_url}/cart/items/{product['id']}", json={"quantity": 3}, headers=headers)
+            
+            if response.status_code == 200:
+                cart = response.json().get("cart", {})
+                line = next((item for item in cart.get("items", []) if item["product_id"] == product["id"]), None)
+                if line and line["quantity"] == 3 and cart["total"] == sum(item["quantity"] * item["price"] for item in cart["items"]):
+                    self.log_test("Set Cart Quantity", True, f"Cart quantity set successfully, total {cart['total']}")
+                    return True
+                else:
+                    self.log_test("Set Cart Quantity", False, "Cart line or total not updated")
+                    return False
+            else:
+                error_msg = response.json().get("detail", "Unknown error") if response.content else f"Status {response.status_code}"
+                self.log_test("Set Cart Quantity", False, f"Failed to set cart quantity: {error_msg}")
+                return False
+                
+        except Exception as e:
+            self.log_test("Set Cart Quantity", False, f"Set cart quantity error: {str(e)}")
+            return False
+    
+    def test_batch_update_cart(self):
+        """Test applying several cart operations in one request"""
+        if not self.user_token:
+            self.log_test("Batch Update Cart", False, "No user token available")
+            return False
+            
+        try:
+            products_response = self.session.get(f"{self.base_url}/products")
+            products = products_response.json() if products_response.status_code == 200 else []
+            if len(products) < 2:
+                self.log_test("Batch Update Cart", False, "Need at least two products for a batch update")
+                return False
+            
+            batch_data = {
+                "operations": [
+                    {"product_id": products[0]["id"], "op": "set", "quantity": 1},
+                    {"product_id": products[1]["id"], "op": "add", "quantity": 2},
+                    {"product_id": products[0]["id"], "op": "remove"}
+                ]
+            }
+            
+            headers = {"Authorization": f"Bearer {self.user_token}"}
+            response = self.session.patch(f"{self.base_url}/cart", json=batch_data, headers=headers)
+            
+            if response.status_code == 200:
+                items = {item["product_id"]: item for item in response.json().get("cart", {}).get("items", [])}
+                if products[0]["id"] not in items and products[1]["id"] in items:
+                    self.log_test("Batch Update Cart", True, f"Batch applied, cart has {len(items)} lines")
+                    return True
+                else:
+                    self.log_test("Batch Update Cart", False, "Batch operations not reflected in cart")
+                    return False
+            else:
+                error_msg = response.json().get("detail", "Unknown error") if response.content else f"Status {response.status_code}"
+                self.log_test("Batch Update Cart", False, f"Failed to apply batch: {error_msg}")
+                return False
+                
+        except Exception as e:
+            self.log_test("Batch Update Cart", False, f"Batch update cart error: {str(e)}")
+            return False
+    
+    def test_bulk_import_products(self):
+        """Test bulk product import from CSV with per-row errors"""
+        if not self.admin_token:
+            self.log_test("Bulk Import Products", False, "No admin token available")
+            return False
+            
+        try:
+            headers = {"Authorization": f"Bearer {self.admin_token}", "Content-Type": "text/csv"}
+            csv_data = (
+                "sku,name,description,price,category,image_url,stock\n"
+                "TEST-BULK-1,Test Bulk Product,Imported by the API tests,199.0,Test,https://example.com/p.jpg,5\n"
+                "TEST-BULK-2,Broken Product,Price is not a number,abc,Test,https://example.com/p.jpg,5\n"
+            )
+            response = self.session.post(f"{self.base_url}/admin/products/bulk", data=csv_data, headers=headers)
+            
+            if response.status_code == 200:
+                result = response.json()
+                imported = result.get("inserted", 0) + result.get("updated", 0)
+                if imported == 1 and result.get("failed") == 1 and result["errors"][0]["row"] == 2:
+                    self.log_test("Bulk Import Products", True, f"Bulk import reported: {result}")
+                    return True
+                else:
+                    self.log_test("Bulk Import Products", False, f"Unexpected import result: {result}")
+                    return False
+            else:
+                error_msg = response.json().get("detail", "Unknown error") if response.content else f"Status {response.status_code}"
+                self.log_test("Bulk Import Products", False, f"Failed to import products: {error_msg}")
+                return False
+                
+        except Exception as e:
+            self.log_test("Bulk Import Products", False, f"Bulk import error: {str(e)}")
+            return False
+    
     def run_all_tests(self):
         """Run all tests in sequence"""
         print("=" * 60)
@@ -289,6 +398,9 @@ class FranciumAPITester:
             ("Admin Stats", self.test_admin_stats),
             ("Add to Cart", self.test_add_to_cart),
             ("Get Cart", self.test_get_cart),
+            ("Set Cart Quantity", self.test_set_cart_quantity),
+            ("Batch Update Cart", self.test_batch_update_cart),
+            ("Bulk Import Products", self.test_bulk_import_products),
         ]
         
         passed = 0
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Per-item cost of serializing list endpoints (/api/products, /api/orders, /api/admin/orders).
+
+"before" mirrors the old handlers: build a model per document, then let FastAPI validate the
+list against response_model, run it through jsonable serialization and json.dumps it.
+"after" is json_list_response: one TypeAdapter validation and a direct dump to JSON bytes.
+
+Usage: python benchmarks/list_serialization.py [items] [rounds]
+"""
+
+import os
+import sys
+import time
+import asyncio
+from datetime import datetime
+from pathlib import Path
+from typing import List
+from uuid import uuid4
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "benchmark")
+
+from fastapi import Response
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+import server
+
+
+def product_docs(count):
+    now = datetime.utcnow()
+    return [{
+        "id": str(uuid4()),
+        "name": f"Product {i}",
+        "description": "High-quality cotton shirt perfect for formal and casual occasions",
+        "price": 1299.0 + i,
+        "category": "Fashion",
+        "image_url": "https://images.unsplash.com/photo-1589810635657-232948472d98?crop=entropy&cs=srgb&fm=jpg&q=85",
+        "stock": 100,
+        "created_at": now,
+        "updated_at": now
+    } for i in range(count)]
+
+
+def order_docs(count):
+    now = datetime.utcnow()
+    return [{
+        "id": str(uuid4()),
+        "user_id": str(uuid4()),
+        "items": [{"product_id": str(uuid4()), "quantity": 2, "price": 899.0} for _ in range(3)],
+        "total": 5394.0,
+        "payment_status": "paid",
+        "order_status": "processing",
+        "razorpay_order_id": f"order_{i}",
+        "razorpay_payment_id": f"pay_{i}",
+        "shipping_address": "123 Test Street, Test City",
+        "created_at": now
+    } for i in range(count)]
+
+
+loop = asyncio.new_event_loop()
+
+
+def before(model, field, docs):
+    content = [model(**doc) for doc in docs]
+    serialized = loop.run_until_complete(serialize_response(field=field, response_content=content))
+    return JSONResponse(serialized).body
+
+
+def after(adapter, docs):
+    return server.json_list_response(adapter, docs, Response()).body
+
+
+def measure(label, func, items, rounds):
+    func()  # warm up
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    per_item = (time.perf_counter() - start) / (rounds * items) * 1e6
+    print(f"  {label:<8} {per_item:8.2f} us/item")
+    return per_item
+
+
+def main():
+    items = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    
+    cases = [
+        ("products", server.Product, server.product_list_adapter, product_docs(items)),
+        ("orders", server.Order, server.order_list_adapter, order_docs(items)),
+    ]
+    for name, model, adapter, docs in cases:
+        field = create_response_field(name="Response_" + name, type_=List[model], mode="serialization")
+        print(f"{name} ({items} items x {rounds} rounds)")
+        old = measure("before", lambda: before(model, field, docs), items, rounds)
+        new = measure("after", lambda: after(adapter, docs), items, rounds)
+        print(f"  speedup  {old / new:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Per-item cost of rendering product and order documents through the app's response class.
+
+Compares FastAPI's stock JSONResponse with server.FastJSONResponse (the app's default response
+class) along the paths a handler that returns content, rather than a Response, can take:
+
+  jsonable   handler returns dicts, no response_model: jsonable_encoder + dump
+  model      handler returns models checked against response_model: validate + serialize + dump
+  direct     handler passes one model to model_response, as GET /api/products/{id} and
+             GET /api/cart do (FastJSONResponse only)
+
+The list endpoints (/api/products, /api/orders, /api/admin/orders) build their own bytes and
+never reach the response class; list_serialization.py measures those.
+
+Usage: python benchmarks/response_rendering.py [items] [rounds]
+"""
+
+import sys
+import time
+import asyncio
+from typing import List
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from list_serialization import product_docs, order_docs, server
+
+
+loop = asyncio.new_event_loop()
+
+
+def jsonable(response_class, docs):
+    return response_class(jsonable_encoder(docs)).body
+
+
+def model(response_class, field, models):
+    serialized = loop.run_until_complete(serialize_response(field=field, response_content=models))
+    return response_class(serialized).body
+
+
+def measure(label, func, items, rounds):
+    func()  # warm up
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    per_item = (time.perf_counter() - start) / (rounds * items) * 1e6
+    print(f"  {label:<20} {per_item:8.2f} us/item")
+    return per_item
+
+
+def main():
+    items = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    fast = server.FastJSONResponse
+
+    cases = [
+        ("products", server.Product, product_docs(items)),
+        ("orders", server.Order, order_docs(items)),
+    ]
+    for name, model_class, docs in cases:
+        field = create_response_field(name="Response_" + name, type_=List[model_class], mode="serialization")
+        models = [model_class(**doc) for doc in docs]
+        print(f"{name} ({items} items x {rounds} rounds)")
+
+        stock = measure("jsonable/JSONResponse", lambda: jsonable(JSONResponse, docs), items, rounds)
+        ours = measure("jsonable/FastJSON", lambda: jsonable(fast, docs), items, rounds)
+        print(f"  speedup  {stock / ours:8.2f}x with jsonable_encoder")
+
+        stock = measure("model/JSONResponse", lambda: model(JSONResponse, field, models), items, rounds)
+        ours = measure("model/FastJSON", lambda: model(fast, field, models), items, rounds)
+        straight = measure("direct/FastJSON", lambda: [fast(item).body for item in models], items, rounds)
+        print(f"  speedup  {stock / ours:8.2f}x via response_model, {stock / straight:8.2f}x direct")
+
+
+if __name__ == "__main__":
+    main()
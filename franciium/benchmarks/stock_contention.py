@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Flash-sale contention on one SKU: single stock counter vs sharded sub-counters.
+
+Runs against a real MongoDB (MONGO_URL, default mongodb://localhost:27017, database DB_NAME,
+default "benchmark"). Each run seeds one product with `stock` units, then `processes` worker
+processes with `buyers` concurrent coroutines each call server.take_stock(product, 1) until the
+product is sold out. Reports throughput and latency, and checks nothing was oversold.
+
+Usage: python benchmarks/stock_contention.py [stock] [processes] [buyers] [shards ...]
+       python benchmarks/stock_contention.py 20000 4 64 0 8 32
+"""
+
+import os
+import sys
+import time
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "benchmark")
+os.environ.setdefault("PRODUCT_CACHE_TTL_SECONDS", "3600")
+
+import server
+
+
+async def seed(product_id, stock, shards):
+    await server.connect_mongo()
+    await server.db.products.delete_many({"id": product_id})
+    await server.db.stock_shards.delete_many({"product_id": product_id})
+    await server.ensure_indexes(server.db)
+    product = server.Product(
+        id=product_id, name="Flash sale item", description="Benchmark product",
+        price=1.0, category="Benchmark", image_url="", stock=stock
+    )
+    await server.db.products.insert_one(product.dict())
+    if shards:
+        await server.set_stock_shards(product_id, shards)
+    server.client.close()
+
+
+async def buy(product_id, buyers):
+    await server.connect_mongo()
+    sold = 0
+    failed = 0
+    latencies = []
+
+    async def buyer():
+        nonlocal sold, failed
+        while True:
+            start = time.perf_counter()
+            ok = await server.take_stock(product_id, 1)
+            latencies.append(time.perf_counter() - start)
+            if not ok:
+                failed += 1
+                return
+            sold += 1
+
+    await asyncio.gather(*[buyer() for _ in range(buyers)])
+    server.client.close()
+    return sold, failed, latencies
+
+
+def run_buyers(product_id, buyers):
+    return asyncio.run(buy(product_id, buyers))
+
+
+async def remaining(product_id):
+    await server.connect_mongo()
+    product = await server.db.products.find_one({"id": product_id}, {"_id": 0, "stock": 1})
+    shards = [doc["stock"] async for doc in server.db.stock_shards.find({"product_id": product_id})]
+    server.client.close()
+    return product["stock"], shards
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    stock = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    buyers = int(sys.argv[3]) if len(sys.argv) > 3 else 64
+    shard_counts = [int(arg) for arg in sys.argv[4:]] or [0, 8, 32]
+
+    for shards in shard_counts:
+        product_id = f"benchmark-flash-sale-{shards}"
+        asyncio.run(seed(product_id, stock, shards))
+
+        start = time.perf_counter()
+        with ProcessPoolExecutor(processes) as pool:
+            results = list(pool.map(run_buyers, [product_id] * processes, [buyers] * processes))
+        elapsed = time.perf_counter() - start
+
+        sold = sum(result[0] for result in results)
+        latencies = [latency for result in results for latency in result[2]]
+        product_stock, shard_stock = asyncio.run(remaining(product_id))
+        left = product_stock + sum(shard_stock)
+        consistent = sold + left == stock and min(shard_stock + [product_stock]) >= 0
+
+        label = f"{shards} shards" if shards else "single counter"
+        print(f"{label} ({processes} processes x {buyers} buyers, {stock} units)")
+        print(f"  throughput {sold / elapsed:10.0f} units/s")
+        print(f"  p50        {percentile(latencies, 0.5) * 1000:10.2f} ms")
+        print(f"  p99        {percentile(latencies, 0.99) * 1000:10.2f} ms")
+        print(f"  sold {sold}, left {left}, {'consistent' if consistent else 'INCONSISTENT'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Bulk import readers and upsert operations, fed from in-memory request streams.
+
+Run from franciium/: python -m pytest tests
+"""
+
+import os
+import sys
+import asyncio
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test")
+
+import server
+
+
+class StreamedRequest:
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    async def stream(self):
+        for chunk in self.chunks:
+            yield chunk
+
+
+def chunked(body: bytes, size: int):
+    return [body[start:start + size] for start in range(0, len(body), size)] or [b""]
+
+
+def read(reader, chunks):
+    async def run():
+        return [(row, item) async for row, item in reader(StreamedRequest(chunks))]
+    return asyncio.run(run())
+
+
+NDJSON = (
+    '{"name": "Lamp Shade", "price": 10}\r\n'
+    '{"name": "Chair\u0085", "price": 20}\r\n'
+    '\r\n'
+    '{"name": "Desk\u2028", "price": 30}\r\n'
+).encode()
+
+CSV = (
+    '\ufeffname,description,price,stock\r\n'
+    'Lamp,"Warm light,\r\ntwo lines",10,\r\n'
+    'Chair,Oak,20,5\r\n'
+    '\r\n'
+    'Désk,"Say ""hi""",30,7'
+).encode()
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, len(NDJSON)])
+def test_ndjson_rows_survive_any_chunking(size):
+    rows = read(server.iter_ndjson_rows, chunked(NDJSON, size))
+    assert rows == [
+        (1, {"name": "Lamp Shade", "price": 10}),
+        (2, {"name": "Chair\u0085", "price": 20}),
+        (4, {"name": "Desk\u2028", "price": 30}),
+    ]
+
+
+def test_ndjson_reports_bad_lines_by_row():
+    rows = read(server.iter_ndjson_rows, [b'{"name": "ok"}\n{broken\n{"name": "also ok"}'])
+    assert [row for row, _ in rows] == [1, 2, 3]
+    assert isinstance(rows[1][1], ValueError)
+
+
+@pytest.mark.parametrize("size", [1, 2, 5, len(CSV)])
+def test_csv_rows_survive_any_chunking(size):
+    rows = read(server.iter_csv_rows, chunked(CSV, size))
+    assert rows == [
+        (1, {"name": "Lamp", "description": "Warm light,\ntwo lines", "price": "10"}),
+        (2, {"name": "Chair", "description": "Oak", "price": "20", "stock": "5"}),
+        (4, {"name": "Désk", "description": 'Say "hi"', "price": "30", "stock": "7"}),
+    ]
+
+
+def test_csv_unterminated_quote_is_reported():
+    rows = read(server.iter_csv_rows, [b'name,price\n"Lamp,10\n'])
+    assert len(rows) == 1
+    assert isinstance(rows[0][1], ValueError)
+
+
+def test_import_operation_leaves_unset_fields_to_inserts():
+    now = datetime(2024, 5, 1)
+    row = server.ProductImportRow.model_validate(
+        {"sku": "LAMP-1", "name": "Lamp", "description": "", "price": "10", "category": "Home", "image_url": ""}
+    )
+    update = server.import_operation(row, now)._doc
+    assert "stock" not in update["$set"]
+    assert update["$set"]["sku"] == "LAMP-1"
+    assert update["$set"]["updated_at"] == now
+    assert update["$setOnInsert"]["stock"] == 0
+    assert update["$setOnInsert"]["created_at"] == now
+    assert not set(update["$set"]) & set(update["$setOnInsert"])
+
+
+def test_import_operation_sets_stock_when_given():
+    row = server.ProductImportRow.model_validate(
+        {"id": "p1", "name": "Lamp", "description": "", "price": 10, "category": "Home", "image_url": "", "stock": "0"}
+    )
+    operation = server.import_operation(row, datetime(2024, 5, 1))
+    assert operation._filter == {"id": "p1"}
+    assert operation._doc["$set"]["stock"] == 0
+    assert "stock" not in operation._doc["$setOnInsert"]
@@ -0,0 +1,135 @@
+"""
+RedisCacheBackend and CacheNamespace against fakeredis. Two backends on one FakeServer stand in
+for two workers sharing a Redis instance.
+
+Run from franciium/: python -m pytest tests
+"""
+
+import os
+import sys
+import asyncio
+from datetime import datetime
+from pathlib import Path
+
+import fakeredis
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test")
+
+import server
+
+
+def worker_backends():
+    redis_server = fakeredis.FakeServer()
+    return [
+        server.RedisCacheBackend(fakeredis.FakeAsyncRedis(server=redis_server), "test")
+        for _ in range(2)
+    ]
+
+
+async def eventually(condition, timeout=2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "condition not met in time"
+        await asyncio.sleep(0.01)
+
+
+async def subscribed(backend, count):
+    async def ready():
+        (_, subscribers), = await backend.redis.pubsub_numsub(backend.channel)
+        return subscribers >= count
+    deadline = asyncio.get_running_loop().time() + 2.0
+    while not await ready():
+        assert asyncio.get_running_loop().time() < deadline, "listener never subscribed"
+        await asyncio.sleep(0.01)
+
+
+@pytest.fixture
+def namespaces(monkeypatch):
+    # Namespaces created by a test register here instead of alongside the app's own
+    registry = {}
+    monkeypatch.setattr(server, "cache_namespaces", registry)
+    return registry
+
+
+def test_backend_round_trip_between_workers():
+    async def run():
+        first, second = worker_backends()
+        key = ("shoes", None, 20, 0, None, ("id", "name"))
+        value = {"id": "p1", "created_at": datetime(2024, 5, 1, 12, 30, 15, 250000), "tags": ["a", "b"]}
+
+        await first.set("products", key, value, 60)
+        assert await second.get("products", key) == value
+        assert await second.get("products", list(key)) == value  # keys come back from JSON as lists
+        assert 0 < await second.redis.pttl(first._key("products", key)) <= 60000
+
+        await second.delete("products", key)
+        assert await first.get("products", key) is None
+
+        await first.set("products", "a", {"n": 1}, 60)
+        await first.set("products", "b", {"n": 2}, 60)
+        await first.set("users", "a", {"n": 3}, 60)
+        await second.clear("products")
+        assert await first.get("products", "a") is None
+        assert await first.get("products", "b") is None
+        assert await first.get("users", "a") == {"n": 3}
+
+        await first.close()
+        await second.close()
+
+    asyncio.run(run())
+
+
+def test_namespace_reads_another_workers_value(monkeypatch, namespaces):
+    async def run():
+        first, second = worker_backends()
+        cache = server.CacheNamespace("products", server.TTLCache(60, 10))
+        key = ("shoes", 20)
+        value = {"id": "p1", "updated_at": datetime(2024, 5, 1, 9, 0)}
+
+        monkeypatch.setattr(server, "cache_backend", first)
+        await cache.set(key, value)
+
+        # Same namespace as seen by the second worker: empty locally, filled from Redis
+        monkeypatch.setattr(server, "cache_backend", second)
+        cache.local.clear()
+        assert await cache.get(key) == value
+        assert cache.shared_hits == 1
+        assert cache.local.get(key) == value
+
+        await first.close()
+        await second.close()
+
+    asyncio.run(run())
+
+
+def test_publish_evicts_other_workers_local_copy(monkeypatch, namespaces):
+    async def run():
+        first, second = worker_backends()
+        monkeypatch.setattr(server, "cache_backend", first)
+        refreshed = []
+        cache = server.CacheNamespace("products", server.TTLCache(60, 10), on_remote_invalidate=refreshed.append)
+        await first.start(server.handle_remote_invalidation)
+        await subscribed(first, 1)
+
+        own_key, other_key = ("p", 1), ("p", 2)
+        await cache.set(own_key, {"id": "p1"})
+        await cache.set(other_key, {"id": "p2"})
+
+        # The first worker ignores its own message; the second worker's evicts the local copy
+        await first.publish("products", own_key)
+        await second.publish("products", other_key)
+        await eventually(lambda: cache.local.get(other_key) is None)
+        assert cache.local.get(own_key) == {"id": "p1"}
+        assert refreshed == [other_key]
+
+        # A clear (key None) drops the whole local namespace
+        await second.publish("products", None)
+        await eventually(lambda: cache.local.get(own_key) is None)
+
+        await first.close()
+        await second.close()
+
+    asyncio.run(run())
@@ -0,0 +1,179 @@
+"""
+ProductSearchIndex and search_page, which run entirely in memory.
+
+Run from franciium/: python -m pytest tests
+"""
+
+import os
+import sys
+import asyncio
+from pathlib import Path
+
+import pytest
+from fastapi import HTTPException
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test")
+
+import server
+
+
+PRODUCTS = [
+    {"id": "p1", "name": "Wireless Headphones", "description": "Noise cancelling", "category": "Electronics"},
+    {"id": "p2", "name": "Running Shoes", "description": "Light and wireless-free", "category": "Sports"},
+    {"id": "p3", "name": "Headphone Stand", "description": "Aluminium stand", "category": "Electronics"},
+    {"id": "p4", "name": "Yoga Mat", "description": "Non-slip", "category": "Sports"},
+]
+
+
+def build(products=PRODUCTS):
+    index = server.ProductSearchIndex()
+    for product in products:
+        index.add(product)
+    return index
+
+
+def ids(results):
+    return [product_id for product_id, _ in results]
+
+
+# Yields documents one at a time, handing control back to the loop in between like a Mongo cursor
+class SlowCollection:
+    def __init__(self, products):
+        self.products = products
+        self.finds = 0
+
+    def find(self, query, projection):
+        self.finds += 1
+        products = list(self.products)
+
+        async def cursor():
+            for product in products:
+                await asyncio.sleep(0)
+                yield dict(product)
+        return cursor()
+
+
+def test_name_matches_outrank_description_matches():
+    assert ids(build().search("wireless")) == ["p1", "p2"]
+
+
+def test_terms_match_as_prefixes_and_all_terms_must_match():
+    index = build()
+    assert ids(index.search("headph")) == ["p1", "p3"]
+    assert ids(index.search("headph stand")) == ["p3"]
+    assert index.search("headph yoga") == []
+
+
+def test_single_letters_only_match_whole_tokens():
+    assert build().search("h") == []
+
+
+def test_category_filter():
+    assert ids(build().search("headph", category="Sports")) == []
+    assert ids(build().search("wireless", category="Sports")) == ["p2"]
+
+
+def test_re_adding_replaces_and_remove_forgets_tokens():
+    index = build()
+    index.add({"id": "p4", "name": "Pilates Mat", "description": "", "category": "Sports"})
+    assert index.search("yoga") == []
+    assert ids(index.search("pilates")) == ["p4"]
+
+    index.remove("p4")
+    assert index.search("mat") == []
+    assert "pilates" not in index._vocabulary
+    assert index.stats()["documents"] == 3
+
+
+def test_search_page_walks_ranked_results_with_cursors():
+    ranked = [("a", 3.0), ("b", 2.0), ("c", 2.0), ("d", 1.0), ("e", 0.5)]
+    first, cursor = server.search_page(ranked, None, 0, 2)
+    assert first == ["a", "b"]
+    second, cursor = server.search_page(ranked, cursor, 0, 2)
+    assert second == ["c", "d"]
+    last, cursor = server.search_page(ranked, cursor, 0, 2)
+    assert last == ["e"]
+    assert cursor is None
+
+
+def test_search_page_skip_and_exact_final_page():
+    ranked = [("a", 3.0), ("b", 2.0), ("c", 1.0), ("d", 0.5)]
+    assert server.search_page(ranked, None, 1, 2) == (["b", "c"], server.encode_cursor({"k": "s", "s": 1.0, "i": "c"}))
+    assert server.search_page(ranked, None, 2, 2) == (["c", "d"], None)
+    assert server.search_page([], None, 0, 2) == ([], None)
+
+
+def test_search_page_rejects_foreign_cursors():
+    catalog_cursor = server.encode_cursor({"k": "c", "t": "2024-01-01T00:00:00", "i": "p1"})
+    with pytest.raises(HTTPException):
+        server.search_page([("a", 1.0)], catalog_cursor, 0, 2)
+    with pytest.raises(HTTPException):
+        server.search_page([("a", 1.0)], "not-a-cursor", 0, 2)
+
+
+def test_rebuild_keeps_serving_the_old_index_until_the_swap():
+    async def run():
+        index = build(PRODUCTS[:1])
+        index.ready = True
+        collection = SlowCollection(PRODUCTS)
+        rebuild = asyncio.create_task(index.rebuild(collection))
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        assert index.ready
+        assert ids(index.search("wireless")) == ["p1"]
+        assert await rebuild
+        assert ids(index.search("wireless")) == ["p1", "p2"]
+
+    asyncio.run(run())
+
+
+def test_writes_during_a_rebuild_are_replayed_onto_the_new_index():
+    async def run():
+        index = build()
+        collection = SlowCollection(PRODUCTS)
+        rebuild = asyncio.create_task(index.rebuild(collection))
+        await asyncio.sleep(0)
+        index.add({"id": "p5", "name": "Trail Shoes", "description": "", "category": "Sports"})
+        index.remove("p4")
+        await rebuild
+        assert ids(index.search("shoes")) == ["p2", "p5"]
+        assert index.search("yoga") == []
+
+    asyncio.run(run())
+
+
+def test_overlapping_rebuilds_coalesce_into_one_more_load():
+    async def run():
+        index = server.ProductSearchIndex()
+        collection = SlowCollection(PRODUCTS)
+        first = asyncio.create_task(index.rebuild(collection))
+        await asyncio.sleep(0)
+        collection.products = PRODUCTS[:3]
+        results = await asyncio.gather(first, index.rebuild(collection), index.rebuild(collection))
+        assert results == [True, False, False]
+        assert collection.finds == 2
+        assert index.ready
+        assert index.stats()["documents"] == 3
+        assert ids(index.search("headph")) == ["p1", "p3"]
+
+    asyncio.run(run())
+
+
+def test_catalog_changes_only_rebuild_without_a_shared_backend(monkeypatch):
+    scheduled = []
+    monkeypatch.setattr(server, "SEARCH_MODE", "index")
+    monkeypatch.setattr(server, "search_index", server.ProductSearchIndex())
+    monkeypatch.setattr(server, "schedule_search_refresh", scheduled.append)
+
+    monkeypatch.setattr(server.cache_backend, "shared", True)
+    server.sync_search_index(5)
+    assert scheduled == []
+    assert server.search_index.catalog_version == 5
+
+    monkeypatch.setattr(server.cache_backend, "shared", False)
+    server.sync_search_index(6)
+    server.sync_search_index(6)
+    assert scheduled == [None]
+    assert server.search_index.catalog_version == 6